@@ -6,19 +6,33 @@ Telegram Bot for Video Conversion
 """
 import sys
 import os
-import tempfile
-import subprocess
+import json
+import time
 import asyncio
-import aiohttp
+import signal
+import shutil
+import collections
+import functools
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 from loguru import logger
 
+# AICODE-NOTE: uvloop - необязательный, более быстрый event loop на libuv (нет под Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 from telethon import TelegramClient, events
-from telethon.tl.types import Message, DocumentAttributeVideo, DocumentAttributeFilename, Document
-from telethon.errors import FilePartTooBigError, FloodWaitError, SessionPasswordNeededError
-from telethon.tl.functions.messages import GetBotCallbackAnswerRequest
+from telethon.tl.types import DocumentAttributeVideo, DocumentAttributeFilename, Document
+from telethon.errors import BadRequestError, FilePartTooBigError, FloodWaitError
 from telethon.tl.custom import Button
+from telethon.tl.types import InputFileBig
+from telethon.tl.functions.upload import SaveBigFilePartRequest
+from telethon.helpers import generate_random_long
 
 # AICODE-NOTE: Настройка loguru логирования с красивым форматированием и ротацией
 logger.remove()  # Удаляем стандартный обработчик
@@ -30,12 +44,25 @@ log_format = (
 )
 
 # Console output
+# AICODE-NOTE: Единственный sink - консоль (логи собирает Docker). enqueue=True переносит
+# форматирование и запись в фоновый поток, чтобы частые логи не блокировали event loop
 logger.add(
-    sys.stdout, format=log_format, level="DEBUG", colorize=True, backtrace=True, diagnose=True
+    sys.stdout,
+    format=log_format,
+    level=os.getenv('LOG_LEVEL', 'DEBUG'),
+    colorize=True,
+    backtrace=True,
+    diagnose=True,
+    enqueue=True,
 )
 
-# Создаем папку для логов
-Path("logs").mkdir(exist_ok=True)
+def _positive_int_env(name: str, default: str) -> int:
+    """Целое значение переменной окружения name, не меньше 1"""
+    value = int(os.getenv(name, default))
+    if value < 1:
+        raise ValueError(f"{name} must be at least 1")
+    return value
+
 
 # Конфигурация
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -52,6 +79,43 @@ if not all([TELEGRAM_API_ID, TELEGRAM_API_HASH]):
 # AICODE-NOTE: Настройка таймаута конвертации через переменную окружения
 CONVERSION_TIMEOUT = int(os.getenv('CONVERSION_TIMEOUT', '300'))  # По умолчанию 5 минут
 
+# AICODE-NOTE: Способ запуска ffmpeg:
+# docker - новый контейнер jrottenberg/ffmpeg на каждую конвертацию (по умолчанию)
+# worker - один постоянный контейнер, ffmpeg запускается в нем через docker exec
+# host - ffmpeg с поддержкой NVENC, установленный на хосте, без Docker
+FFMPEG_BACKEND = os.getenv('FFMPEG_BACKEND', 'docker')
+FFMPEG_BACKENDS = ('docker', 'worker', 'host')
+if FFMPEG_BACKEND not in FFMPEG_BACKENDS:
+    raise ValueError(f"FFMPEG_BACKEND must be one of: {', '.join(FFMPEG_BACKENDS)}")
+FFMPEG_WORKER_NAME = os.getenv('FFMPEG_WORKER_NAME', 'tgbot_ffmpeg')
+
+# AICODE-NOTE: Максимум одновременных конвертаций (сессий NVENC) на GPU
+NVENC_SLOTS = _positive_int_env('NVENC_SLOTS', '2')
+
+# AICODE-NOTE: Telegram ID администраторов через запятую (команда /admin_concurrency)
+ADMIN_USER_IDS = frozenset(
+    int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').replace(' ', '').split(',') if user_id
+)
+
+# AICODE-NOTE: Пресет NVENC (p1 - самый быстрый, p7 - самый медленный и качественный)
+NVENC_PRESET = os.getenv('NVENC_PRESET', 'p4')
+
+# AICODE-NOTE: Production DC Telegram, в которые бот авторизуется при запуске
+TELEGRAM_DC_IDS = (1, 2, 3, 4, 5)
+
+# AICODE-NOTE: Максимум одновременных скачиваний файлов из Telegram
+MAX_CONCURRENT_DOWNLOADS = _positive_int_env('MAX_CONCURRENT_DOWNLOADS', '4')
+
+# AICODE-NOTE: Потоки ffmpeg на одну конвертацию (0 - авто). При нескольких одновременных
+# конвертациях ограничение потоков не дает им отбирать CPU друг у друга
+FFMPEG_THREADS = str(int(os.getenv('FFMPEG_THREADS', '0')))
+
+# AICODE-NOTE: Ограничение частоты загрузок на пользователя (token bucket):
+# не больше USER_RATE_CAP видео подряд, затем одно видео каждые 1 / USER_RATE_PER_SEC секунд
+USER_RATE_CAP = float(os.getenv('USER_RATE_CAP', '3'))
+USER_RATE_PER_SEC = float(os.getenv('USER_RATE_PER_SEC', '0.1'))
+USER_BUCKET_TTL = 3600  # Корзины неактивных пользователей удаляются через час
+
 # AICODE-NOTE: Ограничения Telegram (через Telethon можно загружать файлы до 2 ГБ)
 MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 2 ГБ - максимальный размер файла для загрузки через Telethon
 MAX_SEND_SIZE = 2 * 1024 * 1024 * 1024  # 2 ГБ - максимальный размер файла для отправки через Telethon
@@ -60,8 +124,279 @@ MAX_SEND_SIZE = 2 * 1024 * 1024 * 1024  # 2 ГБ - максимальный ра
 MB = 1024 * 1024
 GB = 1024 * MB
 
-TMP_DIR = Path("/tmp/telegram_video_converter")
-TMP_DIR.mkdir(exist_ok=True)
+# AICODE-NOTE: Минимальный интервал между обновлениями сообщения о прогрессе (секунды)
+PROGRESS_UPDATE_INTERVAL = 3.0
+# AICODE-NOTE: Минимальный объем, скачанный между обновлениями сообщения о прогрессе
+PROGRESS_UPDATE_MIN_BYTES = 5 * MB
+
+# AICODE-NOTE: Размер части при загрузке в Telegram (512 КБ - максимум для Telethon)
+UPLOAD_PART_SIZE_KB = 512
+
+# AICODE-NOTE: Файлы больше BIG_FILE_SIZE Telegram принимает как "большие" (SaveBigFilePart),
+# их части загружаются параллельно UPLOAD_WORKERS запросами
+BIG_FILE_SIZE = 10 * MB
+UPLOAD_WORKERS = _positive_int_env('UPLOAD_WORKERS', '4')
+
+# AICODE-NOTE: Параллельное скачивание: файл делится на DOWNLOAD_WORKERS диапазонов частей,
+# каждый скачивается своим запросом. Больше 4 воркеров часто приводит к FLOOD_WAIT
+DOWNLOAD_WORKERS = _positive_int_env('DOWNLOAD_WORKERS', '4')
+DOWNLOAD_PART_SIZE = 512 * 1024  # Максимальный request_size для iter_download в Telethon
+DOWNLOAD_WRITE_BUFFER = 4 * MB  # Объем, который воркер накапливает перед одной записью на диск
+
+# AICODE-NOTE: Расширения видео файлов (без точки, в нижнем регистре)
+_VIDEO_EXTENSIONS = frozenset(('mp4', 'avi', 'mov', 'mkv', 'wmv', 'flv', 'webm', 'm4v'))
+
+# AICODE-NOTE: Папка для временных файлов. Лучше всего - tmpfs (см. README); для Docker-in-Docker
+# путь должен совпадать на хосте и в контейнере бота. Абсолютный путь вычисляется один раз при запуске
+TMP_DIR = Path(os.getenv('TMP_DIR', '/tmp/telegram_video_converter')).absolute()
+TMP_DIR.mkdir(parents=True, exist_ok=True)
+
+# AICODE-NOTE: Бюджет на суммарный размер исходных файлов в обработке (скачивание, очередь,
+# конвертация, отправка), чтобы всплеск загрузок не переполнил TMP_DIR (tmpfs - это RAM).
+# По умолчанию - половина размера файловой системы TMP_DIR: рядом с каждым исходным файлом лежит результат
+INFLIGHT_LIMIT_GB = os.getenv('INFLIGHT_LIMIT_GB')
+if INFLIGHT_LIMIT_GB:
+    INFLIGHT_BYTES_LIMIT = int(float(INFLIGHT_LIMIT_GB) * GB)
+else:
+    INFLIGHT_BYTES_LIMIT = shutil.disk_usage(TMP_DIR).total // 2
+
+# AICODE-NOTE: Фоновая очистка TMP_DIR: папки старше CLEANUP_MAX_AGE секунд удаляются,
+# проверка выполняется каждые CLEANUP_INTERVAL секунд
+CLEANUP_MAX_AGE = int(os.getenv('CLEANUP_MAX_AGE', '1800'))
+CLEANUP_INTERVAL = 60
+
+# AICODE-NOTE: Обработка одного видео (скачивание, очередь, конвертация, отправка), которая идет
+# дольше JOB_TIMEOUT секунд, отменяется фоновой задачей, чтобы зависший обработчик не держал ресурсы
+JOB_TIMEOUT = int(os.getenv('JOB_TIMEOUT', '3600'))
+SHUTDOWN_TIMEOUT = 30  # Сколько ждать завершения отмененных обработок при остановке бота
+
+# AICODE-NOTE: Максимальная длительность видео в секундах (0 - без ограничения). Проверяется до скачивания
+# по атрибутам документа и после скачивания по ffprobe, до того как видео займет слот NVENC
+MAX_DURATION = int(os.getenv('MAX_DURATION', '0'))
+
+# AICODE-NOTE: Сколько последних результатов помнить для повторной отправки без конвертации (0 - отключить)
+CONVERTED_CACHE_SIZE = int(os.getenv('CONVERTED_CACHE_SIZE', '256'))
+
+# AICODE-NOTE: Статическая часть команды конвертации собирается один раз при импорте,
+# в _convert_video подставляются только рабочая папка и имена входного/выходного файлов
+FFMPEG_IMAGE = "jrottenberg/ffmpeg:5.1.4-nvidia2004"
+# AICODE-NOTE: GPU для контейнеров ffmpeg в формате docker --gpus (all, device=0, "device=0,1")
+FFMPEG_GPUS = os.getenv('FFMPEG_GPUS', 'all')
+DOCKER_RUN_OPTS = ("--rm", "--privileged", "--gpus", FFMPEG_GPUS)
+DOCKER_PREFIX = ("docker", "run", *DOCKER_RUN_OPTS)
+# AICODE-NOTE: В режиме worker утилита запускается через sh: $0 - имя утилиты, PID сохраняется в <утилита>.pid
+WORKER_PIDFILE_SCRIPT = 'echo $$ > "$0.pid" && exec "$0" "$@"'
+# AICODE-NOTE: Декодирование, fps, масштабирование и перевод в yuv420p выполняются на GPU,
+# кадры остаются в видеопамяти от декодера до NVENC без копирования через PCIe
+# -hide_banner -loglevel error: в stderr попадают только ошибки, а не строки прогресса
+FFMPEG_LOG_ARGS = ("-hide_banner", "-loglevel", "error")
+FFMPEG_INPUT_ARGS = (
+    *FFMPEG_LOG_ARGS,
+    "-threads", FFMPEG_THREADS,
+    "-hwaccel", "cuda", "-hwaccel_output_format", "cuda",
+)
+# AICODE-NOTE: Запасной путь для входа, который NVDEC не декодирует: декодирование и масштабирование на CPU,
+# кодирование по-прежнему на NVENC
+FFMPEG_SW_INPUT_ARGS = (
+    *FFMPEG_LOG_ARGS,
+    "-threads", FFMPEG_THREADS,
+)
+FFMPEG_ENCODE_ARGS = (
+    "-c:v", "h264_nvenc",
+    # AICODE-NOTE: p4 в 2-3 раза быстрее p7 при почти том же размере для 1080p@10fps;
+    # -rc vbr с -cq 26 и -b:v 0 - постоянное качество без ограничения битрейта
+    "-preset", NVENC_PRESET,
+    "-tune", "hq",
+    "-rc", "vbr",
+    "-cq", "26",
+    "-b:v", "0",
+    # AICODE-NOTE: B-кадры, lookahead и spatial AQ выполняются на NVENC и почти не замедляют
+    # кодирование, но заметно уменьшают файл при том же -cq
+    "-bf", "3",
+    "-rc-lookahead", "20",
+    "-spatial-aq", "1",
+    "-c:a", "aac",
+    "-b:a", "64k",
+    "-ac", "1",
+    # AICODE-NOTE: Фрагментированный MP4 пишется последовательно, без перезаписи файла в конце
+    "-movflags", "+frag_keyframe+empty_moov+default_base_moof",
+    "-y",
+)
+FFMPEG_OUTPUT_ARGS = ("-vf", "fps=10,scale_cuda=1920:1080:format=yuv420p", *FFMPEG_ENCODE_ARGS)
+FFMPEG_SW_OUTPUT_ARGS = ("-vf", "fps=10,scale=1920:1080,format=yuv420p", *FFMPEG_ENCODE_ARGS)
+# AICODE-NOTE: Фрагменты stderr (в нижнем регистре), по которым ошибка относится к декодированию на NVDEC
+# или к scale_cuda. Только такие ошибки повторяются с декодированием на CPU: ошибки кодировщика,
+# записи или поврежденного файла повторились бы и там, заняв слот еще на один CONVERSION_TIMEOUT
+FFMPEG_HWACCEL_ERRORS = (
+    "hwaccel",
+    "hardware accelerat",
+    "failed setup for format cuda",
+    "cuvid",
+    "nvdec",
+    "decoder surfaces",
+    "scale_cuda",
+    "impossible to convert between the formats",
+)
+# AICODE-NOTE: Для входа, который уже соответствует целевым параметрам, потоки копируются без перекодирования
+FFMPEG_COPY_ARGS = (
+    # AICODE-NOTE: Копируются только первая видеодорожка и аудио (если есть), как при перекодировании;
+    # субтитры и data-потоки (например, tmcd) в MP4 не переносятся
+    "-map", "0:v:0", "-map", "0:a?", "-sn", "-dn",
+    "-c", "copy",
+    "-movflags", "+frag_keyframe+empty_moov+default_base_moof",
+    "-y",
+)
+# AICODE-NOTE: Прогресс в формате key=value пишется в stdout, строка out_time_us= используется для процентов
+FFMPEG_PROGRESS_ARGS = ("-progress", "pipe:1", "-nostats")
+FFMPEG_STDERR_TAIL_LINES = 200
+FFPROBE_ARGS = ("-v", "error", "-of", "json")
+FFPROBE_STREAM_ENTRIES = "stream=codec_type,codec_name,width,height,pix_fmt,r_frame_rate,channels:format=duration"
+FFPROBE_DURATION_ENTRIES = "format=duration"
+PROBE_TIMEOUT = 60
+FFMPEG_KILL_GRACE = 5  # Секунд между SIGTERM и SIGKILL при остановке ffmpeg
+OUTPUT_FILENAME = "converted_video.mp4"
+
+# AICODE-NOTE: Целевые параметры выходного видео (должны совпадать с FFMPEG_OUTPUT_ARGS)
+TARGET_VIDEO_CODEC = "h264"
+TARGET_WIDTH = 1920
+TARGET_HEIGHT = 1080
+TARGET_PIX_FMT = "yuv420p"
+TARGET_FPS = 10
+TARGET_AUDIO_CODEC = "aac"
+TARGET_AUDIO_CHANNELS = 1
+
+# AICODE-NOTE: Тексты и клавиатура зависят только от конфигурации, поэтому собираются один раз при импорте
+# AICODE-NOTE: Создаем клавиатуру с помощью объектов Button из telethon.tl.custom
+START_KEYBOARD = [
+    [Button.inline("🎬 Конвертировать видео", b"convert_video")],
+    [Button.inline("🔧 Статус бота", b"bot_status")]
+]
+
+WELCOME_TEXT = (
+    "🎥 Добро пожаловать в бот для конвертации видео!\n\n"
+    "Этот бот полностью работает на библиотеке Telethon и поддерживает файлы до 2 ГБ.\n\n"
+    "Выберите действие из меню ниже:"
+)
+
+HELP_TEXT = (
+    "🤖 Возможности бота:\n\n"
+    "• /start - Открыть главное меню\n"
+    "• /help - Показать эту справку\n"
+    "• 🎬 Конвертировать видео - Загрузить и конвертировать видео файл\n\n"
+    "📋 Поддерживаемые форматы:\n"
+    "• Входные: MP4, AVI, MOV, MKV и другие\n"
+    "• Выходные: MP4 (H.264, 1920x1080, 10fps)\n\n"
+    "⚙️ Параметры конвертации:\n"
+    "• Разрешение: 1920x1080\n"
+    "• Частота кадров: 10 FPS\n"
+    "• Кодек видео: H.264 (NVENC)\n"
+    "• Кодек аудио: AAC, 64kbps, моно\n"
+    f"• Таймаут: {CONVERSION_TIMEOUT} секунд\n\n"
+    f"📏 Ограничения размера файлов:\n"
+    f"• Максимальный размер для загрузки: {MAX_FILE_SIZE / GB:.1f} ГБ\n"
+    f"• Максимальный размер для отправки: {MAX_SEND_SIZE / GB:.1f} ГБ\n\n"
+    "💡 Просто отправьте видео файл после нажатия кнопки конвертации!\n"
+    "🚀 Бот работает на Telethon - быстрая и надежная работа с большими файлами."
+)
+
+CONVERT_PROMPT_TEXT = (
+    f"📁 Пожалуйста, отправьте видео файл для конвертации.\n\n"
+    f"📋 Поддерживаемые форматы: MP4, AVI, MOV, MKV и другие\n"
+    f"📏 Максимальный размер файла: {MAX_FILE_SIZE / GB:.1f} ГБ\n\n"
+    f"🚀 Бот поддерживает файлы до 2 ГБ благодаря Telethon!"
+)
+
+STATUS_TEXT = (
+    "🔧 Статус бота:\n\n"
+    "✅ Telethon: Активен\n"
+    "✅ Docker: Готов к работе\n"
+    "✅ Конвертация: Доступна\n\n"
+    f"📊 Поддерживаемые размеры файлов: до {MAX_FILE_SIZE / GB:.1f} ГБ\n"
+    f"⏱️ Таймаут конвертации: {CONVERSION_TIMEOUT} секунд\n\n"
+    "🚀 Бот готов к работе!"
+)
+
+RESULT_CAPTION = (
+    "✅ Видео успешно сконвертировано!\n\n"
+    "📊 Параметры:\n"
+    "• Разрешение: 1920x1080\n"
+    "• Частота кадров: 10 FPS\n"
+    "• Кодек: H.264 (NVENC)\n"
+    "• Аудио: AAC, 64kbps"
+)
+
+
+def _filesystem_type(path: Path) -> Optional[str]:
+    """Возвращает тип файловой системы, на которой находится path (по /proc/mounts)"""
+    try:
+        with open('/proc/mounts') as mounts:
+            entries = [line.split()[1:3] for line in mounts]
+    except OSError:
+        return None
+    resolved = str(path.resolve())
+    best_mount, best_type = '', None
+    for mount_point, fs_type in entries:
+        if (resolved == mount_point or resolved.startswith(mount_point.rstrip('/') + '/')) \
+                and len(mount_point) > len(best_mount):
+            best_mount, best_type = mount_point, fs_type
+    return best_type
+
+
+async def _to_thread_uninterrupted(func, *args):
+    """asyncio.to_thread, который при отмене дожидается завершения func в потоке.
+    Нужен для pread/pwrite: после выхода из корутины fd можно закрывать"""
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        while not future.done():
+            try:
+                await asyncio.wait({future})
+            except asyncio.CancelledError:
+                pass
+        raise
+
+
+async def _run_workers(*coros):
+    """Запускает воркеры параллельно. Если один из них падает (или отменяют вызывающего),
+    остальные отменяются, и функция возвращает управление только после завершения всех воркеров"""
+    # AICODE-NOTE: asyncio.gather не отменяет остальные воркеры при ошибке одного, и они продолжали
+    # писать/читать fd после его закрытия (номер fd мог уже принадлежать файлу другой задачи).
+    # TaskGroup недоступен на Python < 3.11
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        while not all(task.done() for task in tasks):
+            try:
+                await asyncio.wait(tasks)
+            except asyncio.CancelledError:
+                pass
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+
+class FFmpegError(Exception):
+    """ffmpeg завершился с ненулевым кодом (в отличие от таймаута или отмены); stderr - хвост вывода ffmpeg"""
+
+    def __init__(self, message: str, stderr: str = ""):
+        super().__init__(message)
+        self.stderr = stderr
+
+
+class _ThreadedFileReader:
+    """Обертка над файлом для Telethon upload_file: read() выполняется в отдельном потоке"""
+
+    def __init__(self, file):
+        self._file = file
+        self.name = file.name
+
+    async def read(self, size: int = -1) -> bytes:
+        return await _to_thread_uninterrupted(self._file.read, size)
+
 
 class VideoConverterBot:
     def __init__(self):
@@ -69,114 +404,120 @@ class VideoConverterBot:
         session_dir = Path("sessions")
         session_dir.mkdir(exist_ok=True)
         
-        # AICODE-NOTE: Инициализируем Telethon клиент
+        # AICODE-NOTE: Инициализируем Telethon клиент.
+        # sequential_updates=False - каждое обновление обрабатывается в отдельной задаче,
+        # поэтому конвертация одного пользователя не блокирует остальных
         self.client = TelegramClient(
             str(session_dir / 'telegram_bot_session'),
             int(TELEGRAM_API_ID),
-            TELEGRAM_API_HASH
+            TELEGRAM_API_HASH,
+            sequential_updates=False,
         )
         
         
+        # AICODE-NOTE: Ограничение одновременных сессий NVENC (на GeForce обычно 2-3).
+        # Счетчик под asyncio.Condition вместо Semaphore, чтобы лимит можно было менять на лету
+        # командой /admin_concurrency
+        self._nvenc_limit = NVENC_SLOTS
+        self._nvenc_active = 0
+        self._nvenc_waiting = 0  # Сколько конвертаций ждут свободный слот NVENC
+        self._nvenc_cond = asyncio.Condition()
+        
+        # AICODE-NOTE: Ограничение одновременных скачиваний (память, диск, сеть)
+        self._download_slots = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+        
+        # AICODE-NOTE: Корзины токенов пользователей: user_id -> (токены, время последнего обновления)
+        self._user_buckets: Dict[int, Tuple[float, float]] = {}
+        
+        # AICODE-NOTE: LRU-кэш результатов: id исходного документа -> отправленный сконвертированный документ
+        self._converted_cache: "collections.OrderedDict[int, Document]" = collections.OrderedDict()
+        
+        # AICODE-NOTE: Отдельный пул для удаления временных файлов: медленный rmtree не занимает
+        # потоки общего пула, в котором идут pread/pwrite скачиваний и отправок
+        self._cleanup_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cleanup')
+        
+        # AICODE-NOTE: Суммарный размер исходных файлов, которые сейчас обрабатываются
+        self._inflight_bytes = 0
+        
+        # AICODE-NOTE: Активные обработки: имя папки в TMP_DIR -> (время начала, задача обработчика)
+        self._active_jobs: Dict[str, Tuple[float, asyncio.Task]] = {}
+        
+        # AICODE-NOTE: Задача остановки бота по SIGTERM (None, пока сигнал не получен)
+        self._shutdown_task: Optional[asyncio.Task] = None
+        
         # AICODE-NOTE: Настройка обработчиков событий
         self._setup_handlers()
     
     def _setup_handlers(self):
         """Настройка обработчиков команд и сообщений"""
         
-        # AICODE-NOTE: Обработчик команды /start
-        @self.client.on(events.NewMessage(pattern='/start'))
-        async def start_handler(event):
-            logger.info(f"/start")
-            await self.start_command(event)
-        
-        # AICODE-NOTE: Обработчик команды /help
-        @self.client.on(events.NewMessage(pattern='/help'))
-        async def help_handler(event):
-            logger.info(f"/help")
-            await self.help_command(event)
+        # AICODE-NOTE: Один обработчик NewMessage вместо отдельных для /start, /help, документов и текста:
+        # Telethon вызывает каждый зарегистрированный обработчик (regex, func-фильтр) на каждое сообщение
+        @self.client.on(events.NewMessage)
+        async def message_handler(event):
+            text = event.raw_text or ''
+            if text.startswith('/start'):
+                logger.info(f"/start")
+                await self.start_command(event)
+            elif text.startswith('/help'):
+                logger.info(f"/help")
+                await self.help_command(event)
+            elif text.startswith('/admin_concurrency'):
+                logger.info(f"/admin_concurrency")
+                await self.admin_concurrency_command(event)
+            elif event.document:
+                logger.info(f"/document")
+                await self.handle_document(event)
+            elif text and not text.startswith('/'):
+                await self.handle_text(event)
         
         # AICODE-NOTE: Обработчик нажатий на кнопки (callback queries)
         @self.client.on(events.CallbackQuery)
         async def callback_handler(event):
             logger.info(f"/button")
             await self.button_callback(event)
-        
-        # AICODE-NOTE: Обработчик документов (видео файлов)
-        @self.client.on(events.NewMessage(func=lambda e: e.document))
-        async def document_handler(event):
-            logger.info(f"/document")
-            await self.handle_document(event)
-        
-        # AICODE-NOTE: Обработчик текстовых сообщений
-        @self.client.on(events.NewMessage(func=lambda e: e.text and not e.text.startswith('/')))
-        async def text_handler(event):
-            await self.handle_text(event)
     
     async def start_command(self, event):
         """Обработчик команды /start"""
-        # AICODE-NOTE: Создаем клавиатуру с помощью объектов Button из telethon.tl.custom
-        keyboard = [
-            [Button.inline("🎬 Конвертировать видео", b"convert_video")],
-            [Button.inline("🔧 Статус бота", b"bot_status")]
-        ]
-        
-        welcome_text = (
-            "🎥 Добро пожаловать в бот для конвертации видео!\n\n"
-            "Этот бот полностью работает на библиотеке Telethon и поддерживает файлы до 2 ГБ.\n\n"
-            "Выберите действие из меню ниже:"
-        )
-        
-        await event.respond(welcome_text, buttons=keyboard)
+        await event.respond(WELCOME_TEXT, buttons=START_KEYBOARD)
     
     async def help_command(self, event):
         """Обработчик команды /help"""
-        max_size_gb = MAX_FILE_SIZE / GB
-        help_text = (
-            "🤖 Возможности бота:\n\n"
-            "• /start - Открыть главное меню\n"
-            "• /help - Показать эту справку\n"
-            "• 🎬 Конвертировать видео - Загрузить и конвертировать видео файл\n\n"
-            "📋 Поддерживаемые форматы:\n"
-            "• Входные: MP4, AVI, MOV, MKV и другие\n"
-            "• Выходные: MP4 (H.264, 1920x1080, 10fps)\n\n"
-            "⚙️ Параметры конвертации:\n"
-            "• Разрешение: 1920x1080\n"
-            "• Частота кадров: 10 FPS\n"
-            "• Кодек видео: H.264 (NVENC)\n"
-            "• Кодек аудио: AAC, 64kbps, моно\n"
-            f"• Таймаут: {CONVERSION_TIMEOUT} секунд\n\n"
-            f"📏 Ограничения размера файлов:\n"
-            f"• Максимальный размер для загрузки: {max_size_gb:.1f} ГБ\n"
-            f"• Максимальный размер для отправки: {max_size_gb:.1f} ГБ\n\n"
-            "💡 Просто отправьте видео файл после нажатия кнопки конвертации!\n"
-            "🚀 Бот работает на Telethon - быстрая и надежная работа с большими файлами."
-        )
+        await event.respond(HELP_TEXT)
+    
+    async def admin_concurrency_command(self, event):
+        """Обработчик команды /admin_concurrency [N] - показывает или меняет лимит конвертаций"""
+        if event.sender_id not in ADMIN_USER_IDS:
+            return
+        
+        args = event.raw_text.split()[1:]
+        if not args:
+            await event.respond(
+                f"⚙️ Лимит одновременных конвертаций: {self._nvenc_limit}\n"
+                f"▶️ Активно: {self._nvenc_active}, в очереди: {self._nvenc_waiting}"
+            )
+            return
+        
+        try:
+            limit = int(args[0])
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            await event.respond("❌ Использование: /admin_concurrency N (N >= 1)")
+            return
         
-        await event.respond(help_text)
+        await self._set_nvenc_limit(limit)
+        logger.info(f"NVENC limit changed to {limit} by {event.sender_id}")
+        await event.respond(f"✅ Лимит одновременных конвертаций: {limit}")
     
     async def button_callback(self, event):
         """Обработчик нажатий на кнопки"""
         await event.answer()
         
         if event.data == b"convert_video":
-            max_size_gb = MAX_FILE_SIZE / GB
-            await event.edit(
-                f"📁 Пожалуйста, отправьте видео файл для конвертации.\n\n"
-                f"📋 Поддерживаемые форматы: MP4, AVI, MOV, MKV и другие\n"
-                f"📏 Максимальный размер файла: {max_size_gb:.1f} ГБ\n\n"
-                f"🚀 Бот поддерживает файлы до 2 ГБ благодаря Telethon!"
-            )
+            await event.edit(CONVERT_PROMPT_TEXT)
         elif event.data == b"bot_status":
-            status_text = (
-                "🔧 Статус бота:\n\n"
-                "✅ Telethon: Активен\n"
-                "✅ Docker: Готов к работе\n"
-                "✅ Конвертация: Доступна\n\n"
-                f"📊 Поддерживаемые размеры файлов: до {MAX_FILE_SIZE / GB:.1f} ГБ\n"
-                f"⏱️ Таймаут конвертации: {CONVERSION_TIMEOUT} секунд\n\n"
-                "🚀 Бот готов к работе!"
-            )
-            await event.edit(status_text)
+            await event.edit(STATUS_TEXT)
     
     async def handle_document(self, event):
         """Обработчик загруженных файлов"""
@@ -205,28 +546,77 @@ class VideoConverterBot:
             )
             return
         
+        # AICODE-NOTE: Длительность из атрибутов документа позволяет отказать до скачивания
+        duration = self._document_duration(document)
+        if MAX_DURATION and duration and duration > MAX_DURATION:
+            await event.respond(
+                f"❌ Видео слишком длинное для обработки!\n\n"
+                f"⏱️ Длительность вашего видео: {duration / 60:.1f} мин\n"
+                f"📏 Максимальная длительность: {MAX_DURATION / 60:.1f} мин\n\n"
+                f"💡 Пожалуйста, обрежьте видео или разделите его на части."
+            )
+            return
+        
+        # AICODE-NOTE: Этот же файл уже конвертировался - пересылаем готовый документ с серверов Telegram
+        # без скачивания, конвертации и загрузки (и без списания лимита пользователя)
+        if await self._send_cached_video(event, document.id):
+            return
+        
+        # AICODE-NOTE: Один файл принимается всегда, даже если он больше бюджета.
+        # Бюджет проверяется до списания токена, чтобы отказ "попробуйте позже" не расходовал лимит пользователя
+        if self._inflight_bytes and self._inflight_bytes + file_size > INFLIGHT_BYTES_LIMIT:
+            await event.respond(
+                "⏳ Сейчас обрабатывается слишком много видео!\n\n"
+                "💡 Попробуйте отправить файл еще раз через пару минут."
+            )
+            return
+        
+        # AICODE-NOTE: Ограничение частоты загрузок для одного пользователя (token bucket)
+        retry_after = self._take_user_token(event.sender_id)
+        if retry_after > 0:
+            await event.respond(
+                f"⏳ Слишком много видео подряд!\n\n"
+                f"💡 Попробуйте снова через {retry_after:.0f} сек."
+            )
+            return
+        
+        # AICODE-NOTE: Байты резервируются сразу после проверки бюджета, без await между ними:
+        # иначе при всплеске загрузок все обработчики проходят проверку, пока ждут event.respond
+        self._inflight_bytes += file_size
+        
         logger.info(f"Документ доступного размера...")
         # Отправляем сообщение о начале обработки
-
-        processing_msg = await event.respond("⏳ Обрабатываю видео...")
+        try:
+            processing_msg = await event.respond("⏳ Обрабатываю видео...")
+        except BaseException:
+            self._inflight_bytes -= file_size
+            raise
         
+        user_tmp_dir = TMP_DIR / f"user_{event.sender_id}_{event.id}"
+        # AICODE-NOTE: Активные папки не удаляются фоновой очисткой TMP_DIR
+        self._active_jobs[user_tmp_dir.name] = (time.monotonic(), asyncio.current_task())
         try:
             # Create temporary directory
-            user_tmp_dir = TMP_DIR / f"user_{event.sender_id}_{event.id}"
             user_tmp_dir.mkdir(exist_ok=True)
             logger.info(f"Создали tmp dir: {user_tmp_dir}")
             
             # ✅ FIXED: Pass correct parameters
-            file_path = await self._download_file_telethon(document, event.chat_id, user_tmp_dir)
+            # AICODE-NOTE: Не больше MAX_CONCURRENT_DOWNLOADS одновременных скачиваний
+            async with self._download_slots:
+                file_path = await self._download_file_telethon(document, file_size, event.chat_id, user_tmp_dir)
             logger.info(f"Файл загружен на сервер")
             
             # Конвертируем видео
-            output_path = await self._convert_video(file_path, user_tmp_dir)
+            output_path = await self._convert_video(
+                file_path, user_tmp_dir, processing_msg,
+                dimensions=self._document_dimensions(document), duration=duration,
+            )
             logger.info(f"Файл сконвертирован")
             
             # Проверяем размер сконвертированного файла
-            if output_path.stat().st_size > MAX_SEND_SIZE:
-                output_size_gb = output_path.stat().st_size / GB
+            output_size = output_path.stat().st_size
+            if output_size > MAX_SEND_SIZE:
+                output_size_gb = output_size / GB
                 max_send_gb = MAX_SEND_SIZE / GB
                 await processing_msg.edit(
                     f"⚠️ Видео успешно сконвертировано, но слишком большое для отправки!\n\n"
@@ -239,14 +629,18 @@ class VideoConverterBot:
                 return
             
             # Отправляем результат
-            await self._send_converted_video(event, output_path, processing_msg)
+            sent_document = await self._send_converted_video(event, output_path, output_size, processing_msg)
+            if sent_document is not None and CONVERTED_CACHE_SIZE > 0:
+                self._converted_cache[document.id] = sent_document
+                if len(self._converted_cache) > CONVERTED_CACHE_SIZE:
+                    self._converted_cache.popitem(last=False)
             
         except Exception as e:
             logger.error(f"Error processing video: {e}", exc_info=True)
             
-            # AICODE-NOTE: Специальная обработка ошибок
-            error_message = str(e)
-            if "file is too big" in error_message.lower():
+            # AICODE-NOTE: Специальная обработка ошибок Telegram по типу исключения
+            # (FilePartTooBigError - подкласс BadRequestError, поэтому проверяется первым)
+            if isinstance(e, FilePartTooBigError):
                 error_text = (
                     "❌ Файл слишком большой для обработки!\n\n"
                     f"📊 Размер файла превышает лимит ({MAX_FILE_SIZE / GB:.1f} ГБ).\n\n"
@@ -256,7 +650,12 @@ class VideoConverterBot:
                     "• Используйте более низкое качество\n"
                     "• Попробуйте другой формат файла"
                 )
-            elif "bad request" in error_message.lower():
+            elif isinstance(e, FloodWaitError):
+                error_text = (
+                    "⏳ Telegram временно ограничил частоту запросов.\n\n"
+                    f"💡 Попробуйте загрузить файл еще раз через {e.seconds} сек."
+                )
+            elif isinstance(e, BadRequestError):
                 error_text = (
                     "❌ Некорректный запрос к Telegram API!\n\n"
                     "Возможные причины:\n"
@@ -266,12 +665,25 @@ class VideoConverterBot:
                     "💡 Попробуйте загрузить файл еще раз через несколько минут."
                 )
             else:
-                error_text = f"❌ Произошла ошибка при обработке видео: {error_message}"
+                error_text = f"❌ Произошла ошибка при обработке видео: {e}"
             
             await processing_msg.edit(error_text)
+        except asyncio.CancelledError:
+            # AICODE-NOTE: Отмена по JOB_TIMEOUT или при остановке бота
+            try:
+                await processing_msg.edit("❌ Обработка видео прервана. Попробуйте отправить файл еще раз.")
+            except Exception as e:
+                logger.warning(f"Could not report cancelled job: {e}")
+            raise
         finally:
             # Очищаем временные файлы
-            await self._cleanup_temp_files(user_tmp_dir)
+            try:
+                await self._cleanup_temp_files(user_tmp_dir)
+            finally:
+                # AICODE-NOTE: Повторная отмена во время очистки (_cancel_stuck_jobs, остановка бота)
+                # не должна оставить запись в _active_jobs и занятый бюджет до перезапуска
+                self._active_jobs.pop(user_tmp_dir.name, None)
+                self._inflight_bytes -= file_size
     
     async def handle_text(self, event):
         """Обработчик текстовых сообщений"""
@@ -281,26 +693,59 @@ class VideoConverterBot:
             "Используйте /start для открытия главного меню или /help для справки."
         )
     
-    def _is_video_file(self, document) -> bool:
+    async def _send_cached_video(self, event, document_id: int) -> bool:
+        """Отправляет ранее сконвертированный документ из кэша, возвращает True при успехе"""
+        cached = self._converted_cache.get(document_id)
+        if cached is None:
+            return False
+        try:
+            await event.respond(RESULT_CAPTION, file=cached)
+        except Exception as e:
+            # AICODE-NOTE: Например, истек file_reference - конвертируем заново
+            logger.warning(f"Could not resend cached video for document {document_id}: {e}")
+            self._converted_cache.pop(document_id, None)
+            return False
+        self._converted_cache.move_to_end(document_id)
+        logger.info(f"Sent cached converted video for document {document_id}")
+        return True
+    
+    def _take_user_token(self, user_id: int) -> float:
+        """Списывает токен из корзины пользователя. Возвращает 0 или сколько секунд ждать следующего"""
+        now = time.monotonic()
+        tokens, last = self._user_buckets.get(user_id, (USER_RATE_CAP, now))
+        tokens = min(USER_RATE_CAP, tokens + (now - last) * USER_RATE_PER_SEC)
+        if tokens < 1:
+            self._user_buckets[user_id] = (tokens, now)
+            return (1 - tokens) / USER_RATE_PER_SEC
+        self._user_buckets[user_id] = (tokens - 1, now)
+        return 0.0
+    
+    def _evict_user_buckets(self):
+        """Удаляет корзины пользователей, не отправлявших видео дольше USER_BUCKET_TTL"""
+        deadline = time.monotonic() - USER_BUCKET_TTL
+        for user_id in [uid for uid, (_, last) in self._user_buckets.items() if last < deadline]:
+            del self._user_buckets[user_id]
+    
+    @staticmethod
+    def _is_video_file(document) -> bool:
         """Проверяет, является ли файл видео"""
-        # AICODE-NOTE: Проверяем MIME тип и атрибуты документа
-        if hasattr(document, 'mime_type') and document.mime_type:
-            if document.mime_type.startswith('video/'):
-                return True
+        # AICODE-NOTE: Самая дешевая проверка - MIME тип, затем один проход по атрибутам
+        mime_type = getattr(document, 'mime_type', None)
+        if mime_type and mime_type.startswith('video/'):
+            return True
         
         # AICODE-NOTE: Проверяем атрибуты документа
         for attr in document.attributes:
             if isinstance(attr, DocumentAttributeVideo):
                 return True
             elif isinstance(attr, DocumentAttributeFilename):
-                filename = attr.file_name.lower()
-                video_extensions = {'.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm', '.m4v'}
-                if any(filename.endswith(ext) for ext in video_extensions):
+                _, dot, extension = attr.file_name.rpartition('.')
+                if dot and extension.lower() in _VIDEO_EXTENSIONS:
                     return True
         
         return False
     
-    async def _download_file_telethon(self, document: Document, chat_id: int, tmp_dir: Path) -> Path:
+    async def _download_file_telethon(self, document: Document, file_size: int, chat_id: int, tmp_dir: Path) -> Path:
         """Proper file download implementation with progress tracking"""
         filename = "input_video" # Имя по умолчанию на случай, если атрибут не найден
         for attr in document.attributes:
@@ -309,8 +754,6 @@ class VideoConverterBot:
                 break
 
         file_path = tmp_dir / filename
-        file_size = document.size or 0
-        MB = 1024 * 1024
 
         # Send initial progress message
         progress_msg = await self.client.send_message(
@@ -319,38 +762,23 @@ class VideoConverterBot:
         )
         
         try:
-            downloaded_size = 0
-            last_update = 0
-            MB = 1024 * 1024
-            
-            # Download file with progress tracking
-            with open(file_path, 'wb') as f:
-                async for chunk in self.client.iter_download(document):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded_size += len(chunk)
-                        
-                        # Update progress every 5MB
-                        if downloaded_size - last_update > (5 * MB) or downloaded_size == file_size:
-                            if file_size > 0:
-                                progress_percent = (downloaded_size / file_size * 100)
-                                # Экранируем символ % с помощью %%
-                                progress_text = (
-                                    f"📥 Downloading: {downloaded_size / MB:.1f}MB/{file_size / MB:.1f}MB "
-                                    f"({progress_percent:.1f}%%)"
-                                )
-                            else:
-                                progress_text = f"📥 Downloading: {downloaded_size / MB:.1f}MB"
-                            
-                            try:
-                                await self.client.edit_message(
-                                    chat_id, 
-                                    progress_msg, 
-                                    text=progress_text
-                                )
-                                last_update = downloaded_size
-                            except Exception as e:
-                                logger.warning(f"Could not update progress: {e}")
+            # AICODE-NOTE: Файл заранее создается нужного размера, а части скачиваются
+            # параллельно и пишутся через os.pwrite по своим смещениям
+            fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                # AICODE-NOTE: Место под весь файл выделяется сразу, без роста файла на каждой записи.
+                # На файловых системах без fallocate glibc заполняет файл по блокам, поэтому вызов в потоке
+                if file_size and hasattr(os, 'posix_fallocate'):
+                    await _to_thread_uninterrupted(os.posix_fallocate, fd, 0, file_size)
+                else:
+                    await _to_thread_uninterrupted(os.ftruncate, fd, file_size)
+                progress_callback, stop_progress = self._make_progress_callback(chat_id, progress_msg)
+                try:
+                    await self._parallel_download(document, fd, file_size, progress_callback)
+                finally:
+                    await stop_progress()
+            finally:
+                os.close(fd)
             
             # Final success message
             await self.client.edit_message(
@@ -372,56 +800,485 @@ class VideoConverterBot:
             )
             raise
     
-    async def _convert_video(self, input_path: Path, tmp_dir: Path) -> Path:
-        """Конвертирует видео с помощью Docker контейнера jrottenberg/ffmpeg с поддержкой NVIDIA"""
-        output_filename = f"converted_video.mp4"
-        output_path = tmp_dir / output_filename
+    async def _parallel_download(self, document: Document, fd: int, file_size: int, progress_callback):
+        """Скачивает документ в fd несколькими параллельными запросами GetFile (DOWNLOAD_WORKERS)"""
+        part_count = max(1, -(-file_size // DOWNLOAD_PART_SIZE))
+        workers = max(1, min(DOWNLOAD_WORKERS, part_count))
+        parts_per_worker = -(-part_count // workers)
+        downloaded_size = 0
 
-        # Docker команда для конвертации с использованием jrottenberg/ffmpeg
-        docker_cmd = [
-            "docker", "run", "--rm",
-            "--privileged",
-            "--gpus", "all",
-            # "--entrypoint", "/bin/sh",
-            "-v", f"{tmp_dir.absolute()}:/workdir",
+        async def download_range(first_part: int, end_part: Optional[int]):
+            nonlocal downloaded_size
+            part = first_part
+            # AICODE-NOTE: Части копятся в буфере и пишутся одним pwrite по DOWNLOAD_WRITE_BUFFER
+            # в отдельном потоке, чтобы запись на медленный диск не блокировала event loop
+            buffer = bytearray()
+            buffer_offset = part * DOWNLOAD_PART_SIZE
+            while end_part is None or part < end_part:
+                try:
+                    async for chunk in self.client.iter_download(
+                        document,
+                        offset=part * DOWNLOAD_PART_SIZE,
+                        limit=None if end_part is None else end_part - part,
+                        request_size=DOWNLOAD_PART_SIZE,
+                    ):
+                        buffer += chunk
+                        part += 1
+                        if len(buffer) >= DOWNLOAD_WRITE_BUFFER:
+                            await _to_thread_uninterrupted(os.pwrite, fd, buffer, buffer_offset)
+                            buffer_offset += len(buffer)
+                            buffer.clear()
+                        downloaded_size += len(chunk)
+                        await progress_callback(downloaded_size, file_size)
+                    # AICODE-NOTE: Файл закончился раньше end_part (последний диапазон)
+                    break
+                except FloodWaitError as e:
+                    # AICODE-NOTE: Ждем только этим воркером и продолжаем с недокачанной части
+                    logger.warning(f"FloodWait on download part {part}, sleeping {e.seconds}s")
+                    await asyncio.sleep(e.seconds)
+            if buffer:
+                await _to_thread_uninterrupted(os.pwrite, fd, buffer, buffer_offset)
+
+        if not file_size:
+            # AICODE-NOTE: Размер документа неизвестен - диапазоны не вычислить, поэтому файл скачивается
+            # одним последовательным запросом до конца, а не обрезается до первой части
+            await download_range(0, None)
+            return
+
+        await _run_workers(*(
+            download_range(i * parts_per_worker, min((i + 1) * parts_per_worker, part_count))
+            for i in range(workers)
+        ))
+    
+    def _make_progress_callback(self, chat_id: int, progress_msg):
+        """Создает progress_callback, обновляющий сообщение не чаще PROGRESS_UPDATE_INTERVAL
+        и не раньше, чем скачано еще PROGRESS_UPDATE_MIN_BYTES.
+        Возвращает (progress_callback, stop_progress): stop_progress отменяет незавершенное обновление"""
+        last_update = 0.0
+        last_update_bytes = 0
+        # AICODE-NOTE: edit_message выполняется в фоновой задаче, скачивание его не ждет;
+        # пока идет одно обновление, новый текст заменяет предыдущий ожидающий (последний побеждает)
+        pending_text: Optional[str] = None
+        edit_task: Optional[asyncio.Task] = None
+
+        async def _edit_loop():
+            nonlocal pending_text
+            while pending_text is not None:
+                text, pending_text = pending_text, None
+                try:
+                    await self.client.edit_message(chat_id, progress_msg, text=text)
+                except Exception as e:
+                    logger.warning(f"Could not update progress: {e}")
+
+        async def _log_progress(current: int, total: int):
+            nonlocal last_update, last_update_bytes, pending_text, edit_task
+            if current != total:
+                if current - last_update_bytes < PROGRESS_UPDATE_MIN_BYTES:
+                    return
+                now = time.monotonic()
+                if now - last_update < PROGRESS_UPDATE_INTERVAL:
+                    return
+            else:
+                now = time.monotonic()
+            last_update = now
+            last_update_bytes = current
+            logger.opt(lazy=True).debug(
+                "Download progress: {} / {} MB", lambda: f"{current / MB:.1f}", lambda: f"{total / MB:.1f}"
+            )
+
+            if total:
+                pending_text = (
+                    f"📥 Downloading: {current / MB:.1f}MB/{total / MB:.1f}MB "
+                    f"({current / total * 100:.1f}%)"
+                )
+            else:
+                pending_text = f"📥 Downloading: {current / MB:.1f}MB"
+
+            if edit_task is None or edit_task.done():
+                edit_task = asyncio.create_task(_edit_loop())
+
+        async def _stop_progress():
+            nonlocal pending_text
+            pending_text = None
+            if edit_task is not None and not edit_task.done():
+                edit_task.cancel()
+                await asyncio.wait({edit_task})
+
+        return _log_progress, _stop_progress
+    
+    def _build_ffmpeg_cmd(self, tmp_dir: Path, ffmpeg_args: tuple, tool: str = "ffmpeg") -> tuple:
+        """Собирает команду запуска ffmpeg/ffprobe с рабочей папкой tmp_dir для выбранного FFMPEG_BACKEND"""
+        if FFMPEG_BACKEND == 'host':
+            # AICODE-NOTE: Рабочая папка задается через cwd при запуске процесса
+            return (tool, *ffmpeg_args)
+        if FFMPEG_BACKEND == 'worker':
+            # AICODE-NOTE: TMP_DIR смонтирован в постоянный контейнер как /workdir.
+            # Сигнал клиенту docker exec не доходит до процесса в контейнере, поэтому процесс записывает
+            # свой PID в <tool>.pid в папке задачи, и _signal_job_process останавливает его через kill
+            return (
+                "docker", "exec",
+                "-w", f"/workdir/{tmp_dir.name}",
+                FFMPEG_WORKER_NAME,
+                "sh", "-c", WORKER_PIDFILE_SCRIPT,
+                tool,
+                *ffmpeg_args,
+            )
+        # AICODE-NOTE: Entrypoint образа jrottenberg/ffmpeg - ffmpeg, для других утилит его заменяем.
+        # ffprobe не использует GPU, поэтому его контейнер запускается без --gpus и --privileged
+        if tool == "ffmpeg":
+            prefix, entrypoint = DOCKER_PREFIX, ()
+        else:
+            prefix, entrypoint = ("docker", "run", "--rm"), ("--entrypoint", tool)
+        return (
+            *prefix,
+            "--name", self._container_name(tmp_dir, tool),
+            "--mount", f"type=bind,source={tmp_dir},target=/workdir",
             "-w", "/workdir",
-            "jrottenberg/ffmpeg:5.1.4-nvidia2004",
-            # "-c", "ffmpeg",
-            "-threads", "0",
-            "-i", input_path.name,
-            "-vf", "fps=10,format=yuv420p",
-            "-c:v", "h264_nvenc",
-            "-preset", "p7",
-            "-cq", "26",
-            "-s", "1920x1080",
-            "-c:a", "aac",
-            "-b:a", "64k",
-            "-ac", "1",
-            "-y", output_filename
-        ]
-        
-        logger.info(f"Running Docker command: {' '.join(docker_cmd)}")
-        
+            *entrypoint,
+            FFMPEG_IMAGE,
+            *ffmpeg_args,
+        )
+    
+    @staticmethod
+    def _container_name(tmp_dir: Path, tool: str) -> str:
+        """Имя контейнера задачи в режиме docker (для docker kill)"""
+        return f"tgbot_{tool}_{tmp_dir.name}"
+    
+    async def _signal_job_process(self, tmp_dir: Path, tool: str, sig: str) -> bool:
+        """Посылает сигнал sig процессу tool задачи внутри Docker.
+        Возвращает False в режиме host, где сигнал посылается самому процессу"""
+        if FFMPEG_BACKEND == 'docker':
+            await self._run_docker("kill", f"--signal={sig}", self._container_name(tmp_dir, tool))
+            return True
+        if FFMPEG_BACKEND == 'worker':
+            await self._run_docker(
+                "exec", "-w", f"/workdir/{tmp_dir.name}", FFMPEG_WORKER_NAME,
+                "sh", "-c", f'kill -{sig} "$(cat {tool}.pid)"',
+            )
+            return True
+        return False
+    
+    async def _run_docker(self, *args: str) -> int:
+        """Выполняет служебную docker команду и возвращает код завершения"""
+        process = await asyncio.create_subprocess_exec(
+            "docker", *args,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            logger.warning(f"docker {args[0]} failed: {stderr.decode(errors='replace').strip()}")
+        return process.returncode
+    
+    async def _start_ffmpeg_worker(self):
+        """Запускает постоянный контейнер ffmpeg, чтобы не создавать контейнер на каждую конвертацию"""
+        # AICODE-NOTE: Удаляем контейнер, оставшийся от предыдущего запуска
+        await self._run_docker("rm", "-f", FFMPEG_WORKER_NAME)
+        returncode = await self._run_docker(
+            "run", "-d", *DOCKER_RUN_OPTS,
+            "--name", FFMPEG_WORKER_NAME,
+            "--mount", f"type=bind,source={TMP_DIR},target=/workdir",
+            "--entrypoint", "sleep",
+            FFMPEG_IMAGE,
+            "infinity",
+        )
+        if returncode != 0:
+            raise Exception(f"Could not start ffmpeg worker container {FFMPEG_WORKER_NAME}")
+        logger.info(f"ffmpeg worker container started: {FFMPEG_WORKER_NAME}")
+    
+    async def _stop_ffmpeg_worker(self):
+        """Останавливает постоянный контейнер ffmpeg"""
+        await self._run_docker("rm", "-f", FFMPEG_WORKER_NAME)
+        logger.info(f"ffmpeg worker container stopped: {FFMPEG_WORKER_NAME}")
+    
+    async def _probe_streams(
+        self, input_path: Path, tmp_dir: Path, entries: str = FFPROBE_STREAM_ENTRIES
+    ) -> Optional[Dict[str, Any]]:
+        """Возвращает описание потоков файла от ffprobe или None, если проверить не удалось"""
+        probe_cmd = self._build_ffmpeg_cmd(
+            tmp_dir, (*FFPROBE_ARGS, "-show_entries", entries, input_path.name), tool="ffprobe"
+        )
         try:
-            # Запускаем Docker контейнер асинхронно
             process = await asyncio.create_subprocess_exec(
-                *docker_cmd,
+                *probe_cmd,
                 stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+                stderr=asyncio.subprocess.PIPE,
+                cwd=tmp_dir
             )
-            
             try:
-                stdout, stderr = await asyncio.wait_for(
-                    process.communicate(),
-                    timeout=CONVERSION_TIMEOUT
-                )
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=PROBE_TIMEOUT)
             except asyncio.TimeoutError:
-                process.kill()
-                await process.wait()
-                raise Exception(f"Конвертация видео заняла слишком много времени (лимит: {CONVERSION_TIMEOUT} секунд)")
-            
+                await self._terminate_process(process, tmp_dir, "ffprobe")
+                logger.warning(f"ffprobe timed out for {input_path}")
+                return None
             if process.returncode != 0:
-                raise Exception(f"Docker command failed: {stderr.decode()}")
+                logger.warning(f"ffprobe failed: {stderr[-4096:].decode('utf-8', 'replace')}")
+                return None
+            return json.loads(stdout)
+        except Exception as e:
+            logger.warning(f"Could not probe {input_path}: {e}")
+            return None
+    
+    @staticmethod
+    def _document_duration(document: Document) -> Optional[float]:
+        """Длительность видео в секундах из DocumentAttributeVideo или None"""
+        for attr in document.attributes:
+            if isinstance(attr, DocumentAttributeVideo):
+                return attr.duration
+        return None
+    
+    @staticmethod
+    def _document_dimensions(document: Document) -> Optional[Tuple[int, int]]:
+        """Ширина и высота видео из DocumentAttributeVideo или None"""
+        for attr in document.attributes:
+            if isinstance(attr, DocumentAttributeVideo) and attr.w and attr.h:
+                return attr.w, attr.h
+        return None
+    
+    @staticmethod
+    def _probe_duration(probe: Optional[Dict[str, Any]]) -> Optional[float]:
+        """Длительность видео в секундах из ответа ffprobe или None"""
+        if probe is None:
+            return None
+        try:
+            return float(probe.get("format", {}).get("duration"))
+        except (TypeError, ValueError):
+            return None
+    
+    @staticmethod
+    def _matches_target_format(probe: Dict[str, Any]) -> bool:
+        """Проверяет, что видео уже H.264 yuv420p 1920x1080 не больше TARGET_FPS, а аудио (если есть) - моно AAC"""
+        streams = probe.get("streams", [])
+        video = [stream for stream in streams if stream.get("codec_type") == "video"]
+        audio = [stream for stream in streams if stream.get("codec_type") == "audio"]
+        if len(video) != 1 or len(audio) > 1:
+            return False
+        
+        video_stream = video[0]
+        if (
+            video_stream.get("codec_name") != TARGET_VIDEO_CODEC
+            or video_stream.get("width") != TARGET_WIDTH
+            or video_stream.get("height") != TARGET_HEIGHT
+            or video_stream.get("pix_fmt") != TARGET_PIX_FMT
+        ):
+            return False
+        try:
+            fps = Fraction(video_stream.get("r_frame_rate", "0/1"))
+        except (ValueError, ZeroDivisionError):
+            return False
+        if not 0 < fps <= TARGET_FPS:
+            return False
+        
+        if audio and (
+            audio[0].get("codec_name") != TARGET_AUDIO_CODEC
+            or audio[0].get("channels") != TARGET_AUDIO_CHANNELS
+        ):
+            return False
+        return True
+    
+    async def _terminate_process(
+        self, process: asyncio.subprocess.Process, tmp_dir: Path, tool: str = "ffmpeg"
+    ):
+        """Останавливает процесс tool задачи tmp_dir: SIGTERM, а через FFMPEG_KILL_GRACE секунд - SIGKILL"""
+        if process.returncode is not None:
+            return
+        # AICODE-NOTE: Сигнал клиенту docker run/docker exec не гарантирует остановку процесса в контейнере
+        # (SIGKILL они не пересылают), поэтому сигнал посылается внутрь Docker, и сессия NVENC освобождается
+        if not await self._signal_job_process(tmp_dir, tool, "TERM"):
+            process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=FFMPEG_KILL_GRACE)
+        except asyncio.TimeoutError:
+            await self._signal_job_process(tmp_dir, tool, "KILL")
+            process.kill()
+            await process.wait()
+    
+    async def _run_ffmpeg(self, cmd: tuple, tmp_dir: Path, duration: Optional[float] = None, status_msg=None):
+        """Запускает ffmpeg и ждет завершения с учетом CONVERSION_TIMEOUT.
+        stdout (-progress) и stderr читаются построчно, чтобы ffmpeg не блокировался на заполненном pipe"""
+        # Запускаем Docker контейнер асинхронно
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=tmp_dir
+        )
+        
+        # AICODE-NOTE: Храним только последние FFMPEG_STDERR_TAIL_LINES строк stderr для сообщения об ошибке
+        stderr_tail = collections.deque(maxlen=FFMPEG_STDERR_TAIL_LINES)
+        
+        async def _drain_stderr():
+            while line := await process.stderr.readline():
+                stderr_tail.append(line)
+        
+        # AICODE-NOTE: status_msg.edit выполняется в фоновой задаче, чтение stdout его не ждет
+        # (медленное редактирование или FloodWait не останавливают ffmpeg на заполненном pipe);
+        # пока идет одно обновление, новый текст заменяет предыдущий ожидающий (последний побеждает)
+        pending_text: Optional[str] = None
+        edit_task: Optional[asyncio.Task] = None
+        
+        async def _edit_loop():
+            nonlocal pending_text
+            while pending_text is not None:
+                text, pending_text = pending_text, None
+                try:
+                    await status_msg.edit(text)
+                except Exception as e:
+                    logger.warning(f"Could not update conversion progress: {e}")
+        
+        async def _read_progress():
+            nonlocal pending_text, edit_task
+            last_update = time.monotonic()
+            while line := await process.stdout.readline():
+                if not line.startswith(b"out_time_us=") or status_msg is None or not duration:
+                    continue
+                now = time.monotonic()
+                if now - last_update < PROGRESS_UPDATE_INTERVAL:
+                    continue
+                try:
+                    out_time = int(line[len(b"out_time_us="):]) / 1_000_000
+                except ValueError:
+                    continue
+                last_update = now
+                percent = min(out_time / duration * 100, 100.0)
+                pending_text = f"⚙️ Конвертирую видео... {percent:.0f}%"
+                if edit_task is None or edit_task.done():
+                    edit_task = asyncio.create_task(_edit_loop())
+        
+        waiters = asyncio.gather(_drain_stderr(), _read_progress(), process.wait())
+        try:
+            await asyncio.wait_for(waiters, timeout=CONVERSION_TIMEOUT)
+        except asyncio.TimeoutError:
+            await self._terminate_process(process, tmp_dir)
+            raise Exception(f"Конвертация видео заняла слишком много времени (лимит: {CONVERSION_TIMEOUT} секунд)")
+        except asyncio.CancelledError:
+            # AICODE-NOTE: Обработчик отменен (например, при остановке бота) - не оставляем ffmpeg работать
+            await asyncio.shield(self._terminate_process(process, tmp_dir))
+            await asyncio.gather(waiters, return_exceptions=True)
+            raise
+        finally:
+            # AICODE-NOTE: Незавершенное обновление прогресса не должно перезаписать следующее сообщение
+            pending_text = None
+            if edit_task is not None and not edit_task.done():
+                edit_task.cancel()
+                await asyncio.wait({edit_task})
+        
+        if process.returncode != 0:
+            # AICODE-NOTE: Декодируем только хвост stderr и только при ошибке
+            stderr = b"".join(stderr_tail)[-4096:].decode('utf-8', 'replace')
+            raise FFmpegError(f"Docker command failed: {stderr}", stderr)
+    
+    async def _acquire_nvenc_slot(self):
+        """Ждет, пока число активных конвертаций станет меньше текущего лимита, и занимает слот"""
+        async with self._nvenc_cond:
+            self._nvenc_waiting += 1
+            try:
+                await self._nvenc_cond.wait_for(lambda: self._nvenc_active < self._nvenc_limit)
+            except asyncio.CancelledError:
+                # AICODE-NOTE: Если отменили уже разбуженную задачу, notify(1) из _release_nvenc_slot
+                # потерялся бы, и следующий в очереди ждал бы при свободном слоте - передаем его дальше
+                self._nvenc_cond.notify(1)
+                raise
+            finally:
+                self._nvenc_waiting -= 1
+            self._nvenc_active += 1
+    
+    async def _release_nvenc_slot(self):
+        """Освобождает слот конвертации и будит следующего в очереди"""
+        async with self._nvenc_cond:
+            self._nvenc_active -= 1
+            self._nvenc_cond.notify(1)
+    
+    async def _set_nvenc_limit(self, limit: int):
+        """Меняет лимит одновременных конвертаций; при увеличении сразу запускает ожидающих"""
+        async with self._nvenc_cond:
+            self._nvenc_limit = limit
+            self._nvenc_cond.notify_all()
+    
+    async def _convert_video(
+        self,
+        input_path: Path,
+        tmp_dir: Path,
+        status_msg=None,
+        dimensions: Optional[Tuple[int, int]] = None,
+        duration: Optional[float] = None,
+    ) -> Path:
+        """Конвертирует видео с помощью Docker контейнера jrottenberg/ffmpeg с поддержкой NVIDIA.
+        dimensions и duration - размер и длительность из атрибутов документа, если известны"""
+        output_path = tmp_dir / OUTPUT_FILENAME
+
+        # AICODE-NOTE: Если вход уже соответствует целевым параметрам, перекодирование не нужно.
+        # Если по атрибутам документа размер не 1920x1080, копирование невозможно и потоки не проверяются,
+        # но при MAX_DURATION длительность все равно читается ffprobe: атрибуты задает клиент отправителя
+        if dimensions is not None and dimensions != (TARGET_WIDTH, TARGET_HEIGHT):
+            probe = await self._probe_streams(input_path, tmp_dir, FFPROBE_DURATION_ENTRIES) if MAX_DURATION else None
+        else:
+            probe = await self._probe_streams(input_path, tmp_dir)
+        stream_copy = probe is not None and self._matches_target_format(probe)
+        duration = self._probe_duration(probe) or duration
+        # AICODE-NOTE: Атрибуты документа задает клиент отправителя, поэтому длительность проверяется еще раз
+        if MAX_DURATION and duration and duration > MAX_DURATION:
+            raise Exception(
+                f"Видео слишком длинное ({duration / 60:.1f} мин, максимум {MAX_DURATION / 60:.1f} мин)"
+            )
+        if stream_copy:
+            ffmpeg_args = (
+                *FFMPEG_LOG_ARGS, *FFMPEG_PROGRESS_ARGS,
+                "-i", input_path.name,
+                *FFMPEG_COPY_ARGS,
+                OUTPUT_FILENAME,
+            )
+        else:
+            ffmpeg_args = (
+                *FFMPEG_PROGRESS_ARGS,
+                *FFMPEG_INPUT_ARGS,
+                "-i", input_path.name,
+                *FFMPEG_OUTPUT_ARGS,
+                OUTPUT_FILENAME,
+            )
+            sw_ffmpeg_args = (
+                *FFMPEG_PROGRESS_ARGS,
+                *FFMPEG_SW_INPUT_ARGS,
+                "-i", input_path.name,
+                *FFMPEG_SW_OUTPUT_ARGS,
+                OUTPUT_FILENAME,
+            )
+
+        # Docker команда для конвертации с использованием jrottenberg/ffmpeg
+        docker_cmd = self._build_ffmpeg_cmd(tmp_dir, ffmpeg_args)
+
+        logger.opt(lazy=True).info("Running Docker command: {}", lambda: " ".join(docker_cmd))
+
+        try:
+            if stream_copy:
+                # AICODE-NOTE: Копирование потоков не использует NVENC и не занимает слот
+                await self._run_ffmpeg(docker_cmd, tmp_dir, duration, status_msg)
+            else:
+                # AICODE-NOTE: Не больше NVENC_SLOTS одновременных сессий NVENC, остальные ждут в очереди
+                if self._nvenc_active >= self._nvenc_limit and status_msg is not None:
+                    try:
+                        await status_msg.edit(
+                            f"⏳ Видео в очереди на конвертацию, место в очереди: {self._nvenc_waiting + 1}"
+                        )
+                    except Exception as e:
+                        logger.warning(f"Could not update queue position: {e}")
+                await self._acquire_nvenc_slot()
+                try:
+                    try:
+                        await self._run_ffmpeg(docker_cmd, tmp_dir, duration, status_msg)
+                    except FFmpegError as e:
+                        # AICODE-NOTE: Кодек/профиль, который NVDEC не декодирует, повторяется с декодированием
+                        # на CPU в том же слоте. Остальные ошибки, таймаут и отмена не повторяются
+                        stderr = e.stderr.lower()
+                        if not any(marker in stderr for marker in FFMPEG_HWACCEL_ERRORS):
+                            raise
+                        logger.warning(f"Hardware decoding failed, retrying with CPU decoding: {e}")
+                        sw_cmd = self._build_ffmpeg_cmd(tmp_dir, sw_ffmpeg_args)
+                        logger.opt(lazy=True).info("Running Docker command: {}", lambda: " ".join(sw_cmd))
+                        await self._run_ffmpeg(sw_cmd, tmp_dir, duration, status_msg)
+                finally:
+                    # AICODE-NOTE: Повторная отмена во время ожидания блокировки не должна пропустить освобождение слота
+                    await asyncio.shield(self._release_nvenc_slot())
             
             if not output_path.exists():
                 raise Exception("Output file was not created")
@@ -433,56 +1290,230 @@ class VideoConverterBot:
             logger.error(f"Docker conversion error: {e}", exc_info=True)
             raise
     
-    async def _send_converted_video(self, event, video_path: Path, processing_msg):
-        """Отправляет сконвертированное видео"""
+    async def _upload_file(self, video_path: Path, file_size: int):
+        """Загружает файл в Telegram; большие файлы - частями параллельно (UPLOAD_WORKERS)"""
+        if file_size <= BIG_FILE_SIZE:
+            with open(video_path, 'rb') as f:
+                return await self.client.upload_file(
+                    _ThreadedFileReader(f),
+                    file_size=file_size,
+                    file_name=video_path.name,
+                    part_size_kb=UPLOAD_PART_SIZE_KB,
+                )
+
+        part_size = UPLOAD_PART_SIZE_KB * 1024
+        part_count = -(-file_size // part_size)
+        file_id = generate_random_long()
+        # AICODE-NOTE: Общий итератор - каждый воркер берет следующую еще не отправленную часть
+        parts = iter(range(part_count))
+
+        async def upload_parts(fd: int):
+            for part_index in parts:
+                data = await _to_thread_uninterrupted(os.pread, fd, part_size, part_index * part_size)
+                while True:
+                    try:
+                        result = await self.client(
+                            SaveBigFilePartRequest(file_id, part_index, part_count, data)
+                        )
+                        break
+                    except FloodWaitError as e:
+                        logger.warning(f"FloodWait on upload part {part_index}, sleeping {e.seconds}s")
+                        await asyncio.sleep(e.seconds)
+                if not result:
+                    raise Exception(f"Failed to upload file part {part_index}")
+
+        fd = os.open(video_path, os.O_RDONLY)
+        try:
+            # AICODE-NOTE: При ошибке одного воркера остальные останавливаются до закрытия fd
+            # и не отправляют части файла, который уже не будет отправлен
+            await _run_workers(*(upload_parts(fd) for _ in range(min(UPLOAD_WORKERS, part_count))))
+        finally:
+            os.close(fd)
+        return InputFileBig(file_id, part_count, video_path.name)
+    
+    async def _send_converted_video(self, event, video_path: Path, file_size: int, processing_msg) -> Optional[Document]:
+        """Отправляет сконвертированное видео, возвращает отправленный документ (None при ошибке)"""
         try:
             # Удаляем сообщение о обработке
             await processing_msg.delete()
             
+            # AICODE-NOTE: Файл загружается частями по 512 КБ (максимум Telethon), а каждое
+            # чтение части выполняется в потоке, чтобы дисковый I/O не блокировал event loop.
+            # Весь результат никогда не копируется в память целиком, большие файлы
+            # загружаются несколькими частями одновременно
+            uploaded_file = await self._upload_file(video_path, file_size)
+            
             # Отправляем видео
-            await event.respond(
-                "✅ Видео успешно сконвертировано!\n\n"
-                "📊 Параметры:\n"
-                "• Разрешение: 1920x1080\n"
-                "• Частота кадров: 10 FPS\n"
-                "• Кодек: H.264 (NVENC)\n"
-                "• Аудио: AAC, 64kbps",
-                file=video_path,
-            )
+            message = await event.respond(RESULT_CAPTION, file=uploaded_file)
             
             logger.info(f"Sent converted video: {video_path}")
+            return message.document
             
         except Exception as e:
             logger.error(f"Error sending video: {e}", exc_info=True)
             await event.respond(f"❌ Ошибка при отправке видео: {str(e)}")
+            return None
     
     async def _cleanup_temp_files(self, tmp_dir: Path):
         """Очищает временные файлы"""
         try:
-            import shutil
             if tmp_dir.exists():
-                shutil.rmtree(tmp_dir)
+                # AICODE-NOTE: Удаление больших файлов выполняется в потоке, не блокируя event loop
+                await asyncio.get_running_loop().run_in_executor(
+                    self._cleanup_executor, functools.partial(shutil.rmtree, tmp_dir, ignore_errors=True)
+                )
                 logger.info(f"Cleaned up temp directory: {tmp_dir}")
         except Exception as e:
             logger.error(f"Error cleaning up temp files: {e}", exc_info=True)
     
+    def _sweep_tmp_dir(self) -> tuple:
+        """Удаляет из TMP_DIR неактивные папки старше CLEANUP_MAX_AGE, возвращает (количество, байт)"""
+        removed_count = 0
+        removed_bytes = 0
+        deadline = time.time() - CLEANUP_MAX_AGE
+        for entry in TMP_DIR.iterdir():
+            if entry.name in self._active_jobs:
+                continue
+            try:
+                if entry.stat().st_mtime > deadline:
+                    continue
+                if entry.is_dir():
+                    for root, _, files in os.walk(entry):
+                        for name in files:
+                            try:
+                                removed_bytes += os.path.getsize(os.path.join(root, name))
+                            except OSError:
+                                pass
+                    shutil.rmtree(entry, ignore_errors=True)
+                else:
+                    removed_bytes += entry.stat().st_size
+                    entry.unlink()
+                removed_count += 1
+            except OSError as e:
+                logger.warning(f"Could not remove stale temp entry {entry}: {e}")
+        return removed_count, removed_bytes
+    
+    def _cancel_stuck_jobs(self):
+        """Отменяет обработки, которые идут дольше JOB_TIMEOUT"""
+        deadline = time.monotonic() - JOB_TIMEOUT
+        for name, (started, task) in list(self._active_jobs.items()):
+            if started < deadline and not task.done():
+                logger.warning(f"Cancelling job {name}: running longer than {JOB_TIMEOUT}s")
+                task.cancel()
+    
+    async def _cancel_active_jobs(self):
+        """Отменяет все активные обработки при остановке бота и ждет их завершения,
+        чтобы контейнеры ffmpeg были остановлены, а временные папки удалены"""
+        tasks = [task for _, task in self._active_jobs.values() if not task.done()]
+        if not tasks:
+            return
+        logger.info(f"Cancelling {len(tasks)} active jobs")
+        for task in tasks:
+            task.cancel()
+        _, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+        if pending:
+            logger.warning(f"{len(pending)} jobs did not finish within {SHUTDOWN_TIMEOUT}s")
+    
+    async def _housekeeping_loop(self):
+        """Периодически удаляет забытые временные папки (после падений, OOM, таймаутов) и старые корзины"""
+        while True:
+            await asyncio.sleep(CLEANUP_INTERVAL)
+            self._evict_user_buckets()
+            self._cancel_stuck_jobs()
+            try:
+                removed_count, removed_bytes = await asyncio.get_running_loop().run_in_executor(
+                    self._cleanup_executor, self._sweep_tmp_dir
+                )
+                if removed_count:
+                    logger.info(
+                        f"Removed {removed_count} stale temp entries ({removed_bytes / MB:.1f} MB) from {TMP_DIR}"
+                    )
+            except Exception as e:
+                logger.error(f"Error sweeping temp directory: {e}", exc_info=True)
+    
+    async def _warm_up_dcs(self):
+        """Экспортирует авторизацию во все DC заранее, чтобы первое скачивание
+        файла из чужого DC не ждало ExportAuthorization/ImportAuthorization"""
+        home_dc = self.client.session.dc_id
+        
+        async def _warm_up(dc_id: int):
+            try:
+                sender = await self.client._borrow_exported_sender(dc_id)
+                await self.client._return_exported_sender(sender)
+                logger.debug(f"Connection to DC {dc_id} is ready")
+            except Exception as e:
+                logger.warning(f"Could not warm up DC {dc_id}: {e}")
+        
+        await asyncio.gather(*(_warm_up(dc_id) for dc_id in TELEGRAM_DC_IDS if dc_id != home_dc))
+    
+    def _request_shutdown(self):
+        """Обработчик SIGTERM: запускает штатную остановку бота"""
+        if self._shutdown_task is not None:
+            return
+        logger.info("Received SIGTERM, shutting down")
+        self._shutdown_task = asyncio.ensure_future(self._shutdown())
+    
+    async def _shutdown(self):
+        """Отменяет активные обработки и затем отключает клиент"""
+        # AICODE-NOTE: Пока клиент подключен, отмененные обработки успевают заменить
+        # "⏳ Обрабатываю видео..." на сообщение о прерывании
+        await self._cancel_active_jobs()
+        await self.client.disconnect()
     
     async def run(self):
         """Запускает бота"""
         logger.info("Starting Telegram Bot with Telethon...")
         
+        fs_type = _filesystem_type(TMP_DIR)
+        if fs_type != 'tmpfs':
+            logger.warning(
+                f"TMP_DIR {TMP_DIR} is on {fs_type or 'unknown'} filesystem, not tmpfs: "
+                f"downloads and conversions will be written to disk"
+            )
+        
+        # AICODE-NOTE: Без cryptg Telethon шифрует MTProto (AES-IGE) на чистом Python,
+        # и скачивание/отправка больших файлов упираются в CPU
+        if importlib.util.find_spec('cryptg') is None:
+            logger.warning("cryptg is not installed: MTProto encryption will be slow for large files")
+        
         try:
+            if FFMPEG_BACKEND == 'worker':
+                await self._start_ffmpeg_worker()
+            
             # AICODE-NOTE: Запускаем Telethon клиент как бот (только bot_token)
             await self.client.start(bot_token=BOT_TOKEN)
             logger.info("Telethon client started successfully")
             
+            # AICODE-NOTE: docker stop посылает SIGTERM, а Python в роли PID 1 без обработчика его игнорирует
+            # и получает SIGKILL - активные обработки не отменяются, контейнеры ffmpeg остаются работать.
+            # Обработки отменяются, пока клиент подключен, затем отключение завершает run_until_disconnected
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self._request_shutdown)
+            except NotImplementedError:
+                pass
+            
+            # AICODE-NOTE: Авторизация в остальных DC заранее, в фоне, чтобы не задерживать запуск
+            warmup_task = asyncio.create_task(self._warm_up_dcs())
+            
+            # AICODE-NOTE: Фоновая очистка TMP_DIR от папок, оставшихся после сбоев
+            sweep_task = asyncio.create_task(self._housekeeping_loop())
+            
             # AICODE-NOTE: Запускаем бота
-            await self.client.run_until_disconnected()
+            try:
+                await self.client.run_until_disconnected()
+            finally:
+                warmup_task.cancel()
+                sweep_task.cancel()
+                await self._cancel_active_jobs()
             
         except KeyboardInterrupt:
             logger.info("Bot stopped by user")
         except Exception as e:
             logger.error(f"Bot error: {e}", exc_info=True)
+        finally:
+            if FFMPEG_BACKEND == 'worker':
+                await self._stop_ffmpeg_worker()
+            self._cleanup_executor.shutdown(wait=True)
     
 
 async def main():
@@ -494,6 +1525,11 @@ async def main():
         logger.info("Bot stopped by user")
     except Exception as e:
         logger.error(f"Bot error: {e}", exc_info=True)
+    finally:
+        # AICODE-NOTE: Дожидаемся записи всех сообщений из очереди логгера
+        await logger.complete()
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,46 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# AICODE-NOTE: telegram_bot читает обязательные переменные окружения при импорте
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "test-token")
+os.environ.setdefault("TELEGRAM_API_ID", "1")
+os.environ.setdefault("TELEGRAM_API_HASH", "test-hash")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+class _StubTelegramClient:
+    """Заменяет TelegramClient в VideoConverterBot.__init__: без сессии и без сети"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def on(self, event):
+        return lambda handler: handler
+
+
+@pytest.fixture
+def make_bot(monkeypatch, tmp_path):
+    """Фабрика ботов через настоящий VideoConverterBot.__init__; client - фейковый клиент Telegram.
+    Бот с asyncio.Condition/Semaphore нужно создавать внутри работающего event loop"""
+    import telegram_bot
+
+    monkeypatch.setattr(telegram_bot, "TelegramClient", _StubTelegramClient)
+    # AICODE-NOTE: __init__ создает папку sessions в текущей папке
+    monkeypatch.chdir(tmp_path)
+    bots = []
+
+    def factory(client=None):
+        bot = telegram_bot.VideoConverterBot()
+        if client is not None:
+            bot.client = client
+        bots.append(bot)
+        return bot
+
+    yield factory
+    for bot in bots:
+        bot._cleanup_executor.shutdown(wait=True)
@@ -0,0 +1,137 @@
+"""Тесты выбора команды ffmpeg в _convert_video"""
+import asyncio
+
+import pytest
+
+import telegram_bot
+from telegram_bot import FFmpegError, VideoConverterBot
+
+
+def stub_ffmpeg(bot, run_ffmpeg, probe=None):
+    """Подменяет запуск ffprobe/ffmpeg; возвращает список -show_entries каждого запуска ffprobe"""
+    probes = []
+
+    async def probe_streams(input_path, tmp_dir, entries=telegram_bot.FFPROBE_STREAM_ENTRIES):
+        probes.append(entries)
+        return probe
+
+    bot._probe_streams = probe_streams
+    bot._run_ffmpeg = run_ffmpeg
+    return probes
+
+
+def test_hwaccel_failure_retries_with_cpu_decoding(tmp_path, make_bot):
+    commands = []
+
+    async def run_ffmpeg(cmd, tmp_dir, duration=None, status_msg=None):
+        commands.append(cmd)
+        if len(commands) == 1:
+            stderr = "[hevc @ 0x1] Failed setup for format cuda: hwaccel initialisation returned error.\n"
+            raise FFmpegError("Docker command failed", stderr)
+        (tmp_dir / telegram_bot.OUTPUT_FILENAME).write_bytes(b"video")
+
+    async def convert():
+        bot = make_bot()
+        stub_ffmpeg(bot, run_ffmpeg)
+        await bot._convert_video(tmp_path / "input.mkv", tmp_path)
+        return bot
+
+    bot = asyncio.run(convert())
+
+    assert len(commands) == 2
+    assert "-hwaccel" in commands[0]
+    assert "-hwaccel" not in commands[1]
+    assert "fps=10,scale=1920:1080,format=yuv420p" in commands[1]
+    assert bot._nvenc_active == 0
+
+
+def test_encoder_failure_is_not_retried(tmp_path, make_bot):
+    commands = []
+
+    async def run_ffmpeg(cmd, tmp_dir, duration=None, status_msg=None):
+        commands.append(cmd)
+        stderr = "[h264_nvenc @ 0x1] OpenEncodeSessionEx failed: out of memory (10)\n"
+        raise FFmpegError("Docker command failed", stderr)
+
+    async def convert():
+        bot = make_bot()
+        stub_ffmpeg(bot, run_ffmpeg)
+        await bot._convert_video(tmp_path / "input.mkv", tmp_path)
+
+    with pytest.raises(FFmpegError):
+        asyncio.run(convert())
+    assert len(commands) == 1
+
+
+def test_timeout_is_not_retried(tmp_path, make_bot):
+    commands = []
+
+    async def run_ffmpeg(cmd, tmp_dir, duration=None, status_msg=None):
+        commands.append(cmd)
+        raise Exception("Конвертация видео заняла слишком много времени")
+
+    async def convert():
+        bot = make_bot()
+        stub_ffmpeg(bot, run_ffmpeg)
+        await bot._convert_video(tmp_path / "input.mkv", tmp_path)
+
+    with pytest.raises(Exception, match="слишком много времени"):
+        asyncio.run(convert())
+    assert len(commands) == 1
+
+
+def test_probe_is_skipped_for_other_dimensions(tmp_path, make_bot):
+    commands = []
+
+    async def run_ffmpeg(cmd, tmp_dir, duration=None, status_msg=None):
+        commands.append((cmd, duration))
+        (tmp_dir / telegram_bot.OUTPUT_FILENAME).write_bytes(b"video")
+
+    async def convert():
+        bot = make_bot()
+        probes = stub_ffmpeg(bot, run_ffmpeg)
+        await bot._convert_video(tmp_path / "input.mkv", tmp_path, dimensions=(1280, 720), duration=42)
+        return probes
+
+    probes = asyncio.run(convert())
+
+    assert probes == []
+    assert len(commands) == 1
+    assert commands[0][1] == 42
+
+
+def test_long_video_with_fake_attributes_is_rejected(tmp_path, monkeypatch, make_bot):
+    monkeypatch.setattr(telegram_bot, "MAX_DURATION", 600)
+    commands = []
+
+    async def run_ffmpeg(cmd, tmp_dir, duration=None, status_msg=None):
+        commands.append(cmd)
+
+    async def convert():
+        bot = make_bot()
+        probes = stub_ffmpeg(bot, run_ffmpeg, probe={"format": {"duration": "7200.0"}})
+        try:
+            # Атрибуты отправителя: 720p и 1 секунда, а файл длится 2 часа
+            await bot._convert_video(tmp_path / "input.mkv", tmp_path, dimensions=(1280, 720), duration=1)
+        finally:
+            assert probes == [telegram_bot.FFPROBE_DURATION_ENTRIES]
+
+    with pytest.raises(Exception, match="слишком длинное"):
+        asyncio.run(convert())
+    assert commands == []
+
+
+def _probe(pix_fmt):
+    return {
+        "streams": [
+            {"codec_type": "video", "codec_name": "h264", "width": 1920, "height": 1080,
+             "pix_fmt": pix_fmt, "r_frame_rate": "10/1"},
+            {"codec_type": "audio", "codec_name": "aac", "channels": 1},
+        ],
+    }
+
+
+def test_stream_copy_requires_yuv420p():
+    assert VideoConverterBot._matches_target_format(_probe("yuv420p"))
+    assert not VideoConverterBot._matches_target_format(_probe("yuv444p"))
+    assert not VideoConverterBot._matches_target_format(_probe("yuv420p10le"))
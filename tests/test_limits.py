@@ -0,0 +1,185 @@
+"""Тесты ограничений обработки: частота загрузок, бюджет INFLIGHT_LIMIT_GB, JOB_TIMEOUT"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import telegram_bot
+
+MB = telegram_bot.MB
+
+
+class FakeMessage:
+    def __init__(self, text):
+        self.texts = [text]
+
+    async def edit(self, text):
+        self.texts.append(text)
+
+    async def delete(self):
+        pass
+
+
+class FakeEvent:
+    """Сообщение с видео; respond ждет release_responds, чтобы обработчики пересекались"""
+
+    def __init__(self, message_id, size, sender_id=1, release_responds=None, respond_error=None):
+        self.id = message_id
+        self.sender_id = sender_id
+        self.chat_id = sender_id
+        self.document = SimpleNamespace(id=message_id, size=size, mime_type="video/mp4", attributes=[])
+        self.release_responds = release_responds
+        self.respond_error = respond_error
+        self.responses = []
+
+    async def respond(self, text, **kwargs):
+        if self.release_responds is not None:
+            await self.release_responds.wait()
+        if self.respond_error is not None:
+            raise self.respond_error
+        message = FakeMessage(text)
+        self.responses.append(message)
+        return message
+
+
+def stub_download(bot, started=None):
+    """Скачивание не выполняется: обработчик ждет started (если задан) и завершается ошибкой"""
+
+    async def download(document, file_size, chat_id, tmp_dir):
+        if started is not None:
+            await started.wait()
+        raise ConnectionError("download skipped")
+
+    bot._download_file_telethon = download
+
+
+def test_user_token_bucket(monkeypatch, make_bot):
+    now = 1000.0
+    monkeypatch.setattr(telegram_bot.time, "monotonic", lambda: now)
+    monkeypatch.setattr(telegram_bot, "USER_RATE_CAP", 3.0)
+    monkeypatch.setattr(telegram_bot, "USER_RATE_PER_SEC", 0.1)
+    bot = make_bot()
+
+    assert [bot._take_user_token(1) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bot._take_user_token(1) == 10.0
+    # Корзины пользователей независимы
+    assert bot._take_user_token(2) == 0.0
+
+    now += 10
+    assert bot._take_user_token(1) == 0.0
+    assert bot._take_user_token(1) > 0
+
+
+def test_stuck_jobs_are_cancelled(make_bot):
+    async def scenario():
+        bot = make_bot()
+        stuck = asyncio.ensure_future(asyncio.sleep(60))
+        fresh = asyncio.ensure_future(asyncio.sleep(60))
+        now = telegram_bot.time.monotonic()
+        bot._active_jobs["stuck"] = (now - telegram_bot.JOB_TIMEOUT - 1, stuck)
+        bot._active_jobs["fresh"] = (now, fresh)
+
+        bot._cancel_stuck_jobs()
+        await asyncio.sleep(0)
+
+        assert stuck.cancelled()
+        assert not fresh.done()
+        fresh.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_inflight_budget_holds_during_burst(tmp_path, monkeypatch, make_bot):
+    monkeypatch.setattr(telegram_bot, "TMP_DIR", tmp_path)
+    monkeypatch.setattr(telegram_bot, "INFLIGHT_BYTES_LIMIT", 150 * MB)
+
+    async def scenario():
+        bot = make_bot()
+        release = asyncio.Event()
+        stub_download(bot, started=release)
+        events = [FakeEvent(message_id, 100 * MB, sender_id=message_id, release_responds=release)
+                  for message_id in (1, 2, 3)]
+        handlers = [asyncio.ensure_future(bot.handle_document(event)) for event in events]
+        await asyncio.sleep(0)
+        # Все обработчики ждут event.respond; бюджет уже зарезервирован только за первым
+        assert bot._inflight_bytes == 100 * MB
+        release.set()
+        await asyncio.gather(*handlers)
+        assert bot._inflight_bytes == 0
+        return events
+
+    events = asyncio.run(scenario())
+
+    assert events[0].responses[0].texts[0] == "⏳ Обрабатываю видео..."
+    for event in events[1:]:
+        assert [message.texts[0] for message in event.responses] == [
+            "⏳ Сейчас обрабатывается слишком много видео!\n\n"
+            "💡 Попробуйте отправить файл еще раз через пару минут."
+        ]
+
+
+def test_budget_rejection_keeps_user_token(tmp_path, monkeypatch, make_bot):
+    monkeypatch.setattr(telegram_bot, "TMP_DIR", tmp_path)
+    monkeypatch.setattr(telegram_bot, "INFLIGHT_BYTES_LIMIT", 150 * MB)
+    monkeypatch.setattr(telegram_bot, "USER_RATE_CAP", 1.0)
+
+    async def scenario():
+        bot = make_bot()
+        stub_download(bot)
+        bot._inflight_bytes = 100 * MB
+        await bot.handle_document(FakeEvent(1, 100 * MB))
+        bot._inflight_bytes = 0
+        # Отказ по бюджету не списал единственный токен - повторная отправка принимается
+        event = FakeEvent(2, 100 * MB)
+        await bot.handle_document(event)
+        return event
+
+    event = asyncio.run(scenario())
+    assert event.responses[0].texts[0] == "⏳ Обрабатываю видео..."
+
+
+def test_reservation_is_rolled_back_when_respond_fails(tmp_path, monkeypatch, make_bot):
+    monkeypatch.setattr(telegram_bot, "TMP_DIR", tmp_path)
+
+    async def scenario():
+        bot = make_bot()
+        stub_download(bot)
+        with pytest.raises(ConnectionError):
+            await bot.handle_document(FakeEvent(1, 100 * MB, respond_error=ConnectionError("lost")))
+        return bot
+
+    bot = asyncio.run(scenario())
+    assert bot._inflight_bytes == 0
+    assert bot._active_jobs == {}
+
+
+def test_cancel_during_cleanup_releases_job(tmp_path, monkeypatch, make_bot):
+    monkeypatch.setattr(telegram_bot, "TMP_DIR", tmp_path)
+
+    async def scenario():
+        bot = make_bot()
+        download_started = asyncio.Event()
+        cleanup_started = asyncio.Event()
+
+        async def download(document, file_size, chat_id, tmp_dir):
+            download_started.set()
+            await asyncio.sleep(60)
+
+        async def cleanup(tmp_dir):
+            cleanup_started.set()
+            await asyncio.sleep(60)
+
+        bot._download_file_telethon = download
+        bot._cleanup_temp_files = cleanup
+        task = asyncio.ensure_future(bot.handle_document(FakeEvent(1, 100 * MB)))
+        await download_started.wait()
+        # Первая отмена по JOB_TIMEOUT, вторая - пока обработчик еще удаляет временные файлы
+        task.cancel()
+        await cleanup_started.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return bot
+
+    bot = asyncio.run(scenario())
+    assert bot._inflight_bytes == 0
+    assert bot._active_jobs == {}
@@ -0,0 +1,56 @@
+"""Тесты очереди слотов NVENC"""
+import asyncio
+
+
+def test_cancelled_waiter_passes_wakeup_on(make_bot):
+    async def scenario():
+        bot = make_bot()
+        await bot._set_nvenc_limit(1)
+        await bot._acquire_nvenc_slot()
+        first = asyncio.ensure_future(bot._acquire_nvenc_slot())
+        second = asyncio.ensure_future(bot._acquire_nvenc_slot())
+        await asyncio.sleep(0)
+
+        # Слот освобождается и будит first, но first отменяют до того, как он его занял
+        await bot._release_nvenc_slot()
+        first.cancel()
+
+        await asyncio.wait_for(second, timeout=1)
+        assert first.cancelled()
+        assert bot._nvenc_active == 1
+        assert bot._nvenc_waiting == 0
+
+    asyncio.run(scenario())
+
+
+def test_slot_is_released_when_cancelled_during_release(tmp_path, make_bot):
+    async def scenario():
+        bot = make_bot()
+        await bot._set_nvenc_limit(1)
+        finished = asyncio.Event()
+
+        async def probe_streams(input_path, tmp_dir):
+            return None
+
+        async def run_ffmpeg(cmd, tmp_dir, duration=None, status_msg=None):
+            await finished.wait()
+
+        bot._probe_streams = probe_streams
+        bot._run_ffmpeg = run_ffmpeg
+        task = asyncio.ensure_future(bot._convert_video(tmp_path / "input.mkv", tmp_path))
+        await asyncio.sleep(0)
+        assert bot._nvenc_active == 1
+
+        # Блокировка условия занята, поэтому освобождение слота ждет и в это время получает отмену
+        async with bot._nvenc_cond:
+            finished.set()
+            await asyncio.sleep(0.01)
+            task.cancel()
+            await asyncio.sleep(0)
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0.01)
+
+        assert task.cancelled()
+        assert bot._nvenc_active == 0
+
+    asyncio.run(scenario())
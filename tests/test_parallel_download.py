@@ -0,0 +1,98 @@
+"""Тесты параллельного скачивания: воркеры не переживают ошибку и не пишут в закрытый fd"""
+import asyncio
+import itertools
+import os
+
+import pytest
+
+import telegram_bot
+
+PART = telegram_bot.DOWNLOAD_PART_SIZE
+
+
+class FakeClient:
+    """iter_download отдает части data; диапазон с fail_offset падает после первой части"""
+
+    def __init__(self, data: bytes, fail_offset=None):
+        self.data = data
+        self.fail_offset = fail_offset
+
+    async def iter_download(self, document, offset, limit, request_size):
+        for index in itertools.count() if limit is None else range(limit):
+            part_offset = offset + index * request_size
+            if part_offset >= len(self.data):
+                return
+            if self.fail_offset is not None and offset == self.fail_offset and index == 1:
+                raise ConnectionError("connection lost")
+            # Остальные воркеры медленнее упавшего
+            await asyncio.sleep(0.01)
+            yield self.data[part_offset:part_offset + request_size]
+
+
+async def no_progress(current, total):
+    pass
+
+
+def test_parallel_download_writes_whole_file(tmp_path, make_bot):
+    data = os.urandom(13 * PART + 123)
+    bot = make_bot(FakeClient(data))
+    path = tmp_path / "video"
+
+    async def run():
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        try:
+            await bot._parallel_download(None, fd, len(data), no_progress)
+        finally:
+            os.close(fd)
+
+    asyncio.run(run())
+    assert path.read_bytes() == data
+
+
+def test_unknown_size_downloads_whole_file(tmp_path, make_bot):
+    data = os.urandom(5 * PART + 7)
+    bot = make_bot(FakeClient(data))
+    path = tmp_path / "video"
+
+    async def run():
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        try:
+            await bot._parallel_download(None, fd, 0, no_progress)
+        finally:
+            os.close(fd)
+
+    asyncio.run(run())
+    assert path.read_bytes() == data
+
+
+def test_failed_worker_stops_siblings_before_return(tmp_path, monkeypatch, make_bot):
+    data = os.urandom(64 * PART)
+    # Второй из 4 диапазонов падает на второй части
+    bot = make_bot(FakeClient(data, fail_offset=16 * PART))
+    returned = False
+    writes_after_return = []
+    real_pwrite = os.pwrite
+
+    def tracking_pwrite(fd, buffer, offset):
+        if returned:
+            writes_after_return.append(offset)
+        return real_pwrite(fd, buffer, offset)
+
+    monkeypatch.setattr(telegram_bot.os, "pwrite", tracking_pwrite)
+
+    async def run():
+        nonlocal returned
+        fd = os.open(tmp_path / "video", os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        try:
+            with pytest.raises(ConnectionError):
+                await bot._parallel_download(None, fd, len(data), no_progress)
+        finally:
+            returned = True
+            os.close(fd)
+        # Даем возможным осиротевшим воркерам время проявиться
+        await asyncio.sleep(0.5)
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        assert pending == []
+
+    asyncio.run(run())
+    assert writes_after_return == []
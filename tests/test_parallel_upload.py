@@ -0,0 +1,54 @@
+"""Тесты параллельной отправки больших файлов частями SaveBigFilePartRequest"""
+import asyncio
+import os
+
+import pytest
+
+import telegram_bot
+
+PART = telegram_bot.UPLOAD_PART_SIZE_KB * 1024
+
+
+class FakeClient:
+    """Принимает SaveBigFilePartRequest; часть fail_part завершается ошибкой"""
+
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.parts = {}
+
+    async def __call__(self, request):
+        await asyncio.sleep(0.01)
+        if request.file_part == self.fail_part:
+            raise ConnectionError("connection lost")
+        self.parts[request.file_part] = request.bytes
+        return True
+
+
+def test_upload_sends_all_parts(tmp_path, make_bot):
+    data = os.urandom(telegram_bot.BIG_FILE_SIZE + 3 * PART + 17)
+    path = tmp_path / "converted_video.mp4"
+    path.write_bytes(data)
+    client = FakeClient()
+
+    uploaded = asyncio.run(make_bot(client)._upload_file(path, len(data)))
+
+    assert uploaded.parts == len(client.parts)
+    assert b"".join(client.parts[index] for index in range(uploaded.parts)) == data
+
+
+def test_failed_upload_stops_siblings_before_return(tmp_path, make_bot):
+    data = os.urandom(telegram_bot.BIG_FILE_SIZE + 3 * PART)
+    path = tmp_path / "converted_video.mp4"
+    path.write_bytes(data)
+    client = FakeClient(fail_part=2)
+
+    async def run():
+        with pytest.raises(ConnectionError):
+            await make_bot(client)._upload_file(path, len(data))
+        sent = len(client.parts)
+        await asyncio.sleep(0.3)
+        # После ошибки части больше не отправляются, и воркеров не осталось
+        assert len(client.parts) == sent
+        assert [task for task in asyncio.all_tasks() if task is not asyncio.current_task()] == []
+
+    asyncio.run(run())
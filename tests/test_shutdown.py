@@ -0,0 +1,41 @@
+"""Тесты остановки бота по SIGTERM"""
+import asyncio
+
+
+class FakeClient:
+    def __init__(self):
+        self.connected = True
+        self.disconnects = 0
+
+    async def disconnect(self):
+        self.disconnects += 1
+        self.connected = False
+
+
+def test_sigterm_cancels_jobs_before_disconnect(make_bot):
+    client = FakeClient()
+    connected_on_cancel = []
+
+    async def job():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            # Обработчик сообщает пользователю о прерывании через клиент
+            connected_on_cancel.append(client.connected)
+            raise
+
+    async def scenario():
+        bot = make_bot(client)
+        task = asyncio.ensure_future(job())
+        bot._active_jobs["user_1_1"] = (0.0, task)
+        await asyncio.sleep(0)
+
+        bot._request_shutdown()
+        bot._request_shutdown()
+        await bot._shutdown_task
+        assert task.cancelled()
+
+    asyncio.run(scenario())
+
+    assert connected_on_cancel == [True]
+    assert client.disconnects == 1
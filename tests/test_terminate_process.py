@@ -0,0 +1,105 @@
+"""Тесты остановки ffmpeg при таймауте и отмене в разных FFMPEG_BACKEND"""
+import asyncio
+import sys
+
+import telegram_bot
+
+
+class FakeProcess:
+    """Процесс клиента docker run/docker exec, который завершается только после docker kill/kill"""
+
+    def __init__(self):
+        self.returncode = None
+        self.signals = []
+        self._exited = asyncio.Event()
+
+    def exit(self, returncode):
+        self.returncode = returncode
+        self._exited.set()
+
+    def terminate(self):
+        self.signals.append("TERM")
+        self.exit(-15)
+
+    def kill(self):
+        self.signals.append("KILL")
+        self.exit(-9)
+
+    async def wait(self):
+        await self._exited.wait()
+        return self.returncode
+
+
+def stub_docker(bot, docker_calls, process):
+    """Подменяет служебные docker команды: каждая записывается и завершает process"""
+
+    async def run_docker(*args):
+        docker_calls.append(args)
+        process.exit(137)
+        return 0
+
+    bot._run_docker = run_docker
+    return bot
+
+
+def test_worker_mode_kills_process_inside_container(tmp_path, monkeypatch, make_bot):
+    monkeypatch.setattr(telegram_bot, "FFMPEG_BACKEND", "worker")
+    docker_calls = []
+
+    async def terminate():
+        process = FakeProcess()
+        await stub_docker(make_bot(), docker_calls, process)._terminate_process(process, tmp_path / "user_1_2")
+        return process
+
+    process = asyncio.run(terminate())
+
+    assert docker_calls == [(
+        "exec", "-w", "/workdir/user_1_2", telegram_bot.FFMPEG_WORKER_NAME,
+        "sh", "-c", 'kill -TERM "$(cat ffmpeg.pid)"',
+    )]
+    assert process.signals == []
+
+
+def test_worker_command_writes_pidfile(tmp_path, monkeypatch, make_bot):
+    monkeypatch.setattr(telegram_bot, "FFMPEG_BACKEND", "worker")
+    bot = make_bot()
+
+    cmd = bot._build_ffmpeg_cmd(tmp_path / "user_1_2", ("-i", "input.mkv"))
+
+    assert cmd[cmd.index("sh"):] == ("sh", "-c", telegram_bot.WORKER_PIDFILE_SCRIPT, "ffmpeg", "-i", "input.mkv")
+
+
+def test_host_mode_signals_process(tmp_path, monkeypatch, make_bot):
+    monkeypatch.setattr(telegram_bot, "FFMPEG_BACKEND", "host")
+    docker_calls = []
+
+    async def terminate():
+        process = FakeProcess()
+        await stub_docker(make_bot(), docker_calls, process)._terminate_process(process, tmp_path)
+        return process
+
+    process = asyncio.run(terminate())
+
+    assert docker_calls == []
+    assert process.signals == ["TERM"]
+
+
+def test_slow_progress_edit_does_not_stall_ffmpeg(tmp_path, monkeypatch, make_bot):
+    monkeypatch.setattr(telegram_bot, "FFMPEG_BACKEND", "host")
+    monkeypatch.setattr(telegram_bot, "PROGRESS_UPDATE_INTERVAL", 0)
+    monkeypatch.setattr(telegram_bot, "CONVERSION_TIMEOUT", 5)
+    edits = []
+
+    class SlowMessage:
+        async def edit(self, text):
+            edits.append(text)
+            # Например, FloodWait при редактировании сообщения
+            await asyncio.sleep(60)
+
+    script = "for i in range(20000): print(f'out_time_us={i * 1000}')"
+
+    async def run():
+        await make_bot()._run_ffmpeg((sys.executable, "-c", script), tmp_path, 20.0, SlowMessage())
+
+    asyncio.run(run())
+    assert len(edits) == 1